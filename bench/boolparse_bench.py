@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+#
+# Compares boolparse.BoolParser with the old pyparsing based parser on
+# randomly generated use_if() expressions.
+#
+# usage: bench/boolparse_bench.py [-n expressions] [-m modules] [-r evaluations]
+#
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import boolparse
+import pyparsing_boolparse
+
+def random_expr(rnd, names, depth=0):
+    choice = rnd.random()
+    if depth > 3 or choice < 0.4:
+        return rnd.choice(names)
+    if choice < 0.55:
+        return "not " + random_expr(rnd, names, depth+1)
+    if choice < 0.7:
+        return "(" + random_expr(rnd, names, depth+1) + ")"
+    op = rnd.choice([" and ", " or "])
+    return random_expr(rnd, names, depth+1) + op + random_expr(rnd, names, depth+1)
+
+def timed(func):
+    before = time.perf_counter()
+    res = func()
+    return time.perf_counter() - before, res
+
+def run(parser, exprs, evaluations):
+    parse_time, parsed = timed(lambda: [parser.parseString(e)[0] for e in exprs])
+    eval_time, results = timed(lambda: [[bool(p) for p in parsed] for i in range(evaluations)][0])
+    return parse_time, eval_time, results
+
+def main():
+    parser = argparse.ArgumentParser(description='boolparse benchmark')
+    parser.add_argument('-n', type=int, default=5000, help='number of expressions')
+    parser.add_argument('-m', type=int, default=300, help='number of module names')
+    parser.add_argument('-r', type=int, default=10, help='evaluations per expression')
+    parser.add_argument('-s', '--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rnd = random.Random(args.seed)
+    names = ["module_%i" % i for i in range(args.m)]
+    used = set(rnd.sample(names, args.m // 2))
+    exprs = [random_expr(rnd, names) for i in range(args.n)]
+
+    is_used = lambda name: name in used
+
+    print("%i expressions over %i modules, %i evaluations each" % (args.n, args.m, args.r))
+
+    before = time.perf_counter()
+    new = boolparse.BoolParser(is_used)
+    setup = time.perf_counter() - before
+    parse_time, eval_time, results = run(new, exprs, args.r)
+    print("builtin:   setup %.4fs parse %.4fs eval %.4fs" % (setup, parse_time, eval_time))
+
+    parse_time, eval_time, results = run(new, exprs, args.r)
+    print("memoized:  setup %.4fs parse %.4fs eval %.4fs" % (0, parse_time, eval_time))
+
+    try:
+        before = time.perf_counter()
+        old = pyparsing_boolparse.PyparsingBoolParser(is_used)
+        setup = time.perf_counter() - before
+    except ImportError:
+        print("pyparsing: not installed, skipped.")
+        return
+
+    parse_time, eval_time, old_results = run(old, exprs, args.r)
+    print("pyparsing: setup %.4fs parse %.4fs eval %.4fs" % (setup, parse_time, eval_time))
+
+    mismatches = [e for e, a, b in zip(exprs, results, old_results) if a != b]
+    for expr in mismatches[:10]:
+        print("mismatch:", expr)
+    if mismatches:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
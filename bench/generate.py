@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+#
+# Generates a synthetic pyjam project: N modules (each with S sources and
+# random needs/uses/use_if edges to other modules), M examples using some of
+# them, built for K boards using build_matrix().
+#
+# Every context defines all modules, so the number of targets is roughly
+# N * S * M * K (compiled or not).
+#
+# usage: bench/generate.py [-n modules] [-s sources] [-m examples] [-k boards] [--stub] dir
+#
+
+import argparse
+import os
+import random
+
+stub_script = '''\
+#!/bin/sh
+# stub compiler / linker, only creates the file given with "-o"
+while [ $# -gt 0 ]; do
+    if [ "$1" = "-o" ]; then
+        touch "$2"
+        exit 0
+    fi
+    shift
+done
+'''
+
+def write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(content)
+
+def module_buildfile(rnd, i):
+    name = "mod%i" % i
+    lines = [ 'm = Module("%s")' % name ]
+    if i:
+        others = ["mod%i" % j for j in range(i)]
+        needs = rnd.sample(others, min(len(others), rnd.randint(0, 3)))
+        uses = rnd.sample(others, min(len(others), rnd.randint(0, 2)))
+        if needs:
+            lines.append("m.needs(%r)" % needs)
+        if uses:
+            lines.append("m.uses(%r)" % uses)
+        if rnd.random() < 0.3:
+            a, b = rnd.choice(others), rnd.choice(others)
+            lines.append('m.use_if("%s and not %s")' % (a, b))
+    return "\n".join(lines) + "\n"
+
+def generate(basedir, modules=50, sources=4, examples=4, boards=2, seed=0, stub=False):
+    rnd = random.Random(seed)
+
+    for i in range(modules):
+        moddir = os.path.join(basedir, "modules", "mod%i" % i)
+        write(os.path.join(moddir, "build.py"), module_buildfile(rnd, i))
+        write(os.path.join(moddir, "mod%i.h" % i), "int mod%i_0(void);\n" % i)
+        for j in range(sources):
+            write(os.path.join(moddir, "mod%i_%i.c" % (i, j)),
+                    '#include "mod%i.h"\nint mod%i_%i(void) { return %i; }\n' % (i, i, j, j))
+
+    example_dirs = []
+    for i in range(examples):
+        name = "example%i" % i
+        exdir = os.path.join(basedir, "examples", name)
+        example_dirs.append(os.path.join("examples", name))
+        needs = rnd.sample(["mod%i" % j for j in range(modules)], min(modules, 5))
+        write(os.path.join(exdir, "main.c"), "int main(void) { return 0; }\n")
+        write(os.path.join(exdir, "build.py"),
+                'm = Module("%s").needs(%r)\n' % (name, needs) +
+                'm.collect_modules()\n' +
+                'LinkModule(locate_bin("%s.elf"), m.name)\n' % name +
+                'depends("all", locate_bin("%s.elf"))\n' % name)
+
+    project = []
+    if stub:
+        stub_path = os.path.join(basedir, "stub.sh")
+        write(stub_path, stub_script)
+        os.chmod(stub_path, 0o755)
+        project.append("default.CC = %r" % stub_path)
+        project.append("default.LINK = %r" % stub_path)
+
+    project.append("module_dirs = %r" % [os.path.join("modules", "mod%i" % i) for i in range(modules)])
+    project.append('''
+def board_setup(board):
+    ctx.CFLAGS = "-DBOARD_" + board.upper()
+
+def setup(board, example):
+    for module_dir in module_dirs:
+        subinclude(module_dir)
+''')
+    project.append("build_matrix(%r, %r, board_setup, setup)" %
+            (example_dirs, ["board%i" % i for i in range(boards)]))
+
+    write(os.path.join(basedir, "project.py"), "\n".join(project) + "\n")
+
+def main():
+    parser = argparse.ArgumentParser(description='generate a synthetic pyjam project')
+    parser.add_argument('-n', '--modules', type=int, default=50)
+    parser.add_argument('-s', '--sources', type=int, default=4, help='sources per module')
+    parser.add_argument('-m', '--examples', type=int, default=4)
+    parser.add_argument('-k', '--boards', type=int, default=2)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--stub', action="store_true", help='use a stub instead of gcc')
+    parser.add_argument('dir')
+    args = parser.parse_args()
+
+    generate(args.dir, args.modules, args.sources, args.examples, args.boards, args.seed, args.stub)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+#
+# The original pyparsing based use_if() parser, only kept as reference for
+# bench/boolparse_bench.py. pyparsing gets imported on instantiation.
+#
+#
+# simpleBool.py
+#
+# Example of defining a boolean logic parser using
+# the operatorGrammar helper method in pyparsing.
+#
+# In this example, parse actions associated with each
+# operator expression will "compile" the expression
+# into BoolXXX class instances, which can then
+# later be evaluated for their boolean value.
+#
+# Copyright 2006, by Paul McGuire
+# Updated 2013-Sep-14 - improved Python 2/3 cross-compatibility
+#
+class PyparsingBoolParser(object):
+
+    # define classes to be built at parse time, as each matching
+    # expression type is parsed
+    class BoolOperand(object):
+        def __init__(self, t, eval_func=eval):
+            self.label = t[0]
+            self.func = eval_func
+        def __bool__(self):
+            return self.func(self.label)
+        def __str__(self):
+            return self.label
+        def labels(self):
+            yield self.label
+        __repr__ = __str__
+        __nonzero__ = __bool__
+
+    class BoolBinOp(object):
+        def __init__(self,t):
+            self.args = t[0][0::2]
+        def __str__(self):
+            sep = " %s " % self.reprsymbol
+            return "(" + sep.join(map(str,self.args)) + ")"
+        def __bool__(self):
+            return self.evalop(bool(a) for a in self.args)
+        def labels(self):
+            for a in self.args:
+                yield from a.labels()
+        __nonzero__ = __bool__
+        __repr__ = __str__
+
+    class BoolAnd(BoolBinOp):
+        reprsymbol = '&'
+        evalop = all
+
+    class BoolOr(BoolBinOp):
+        reprsymbol = '|'
+        evalop = any
+
+    class BoolNot(object):
+        def __init__(self,t):
+            self.arg = t[0][1]
+        def __bool__(self):
+            v = bool(self.arg)
+            return not v
+        def __str__(self):
+            return "~" + str(self.arg)
+        def labels(self):
+            return self.arg.labels()
+        __repr__ = __str__
+        __nonzero__ = __bool__
+
+    def _eval(s, t):
+        return PyparsingBoolParser.BoolOperand(t, s.eval_func)
+
+    def __init__(s, eval_func=eval):
+        from pyparsing import infixNotation, opAssoc, Regex
+
+        s.eval_func = eval_func
+        s.boolOperand = Regex('[\w>=0-9]+')
+        s.boolOperand.setParseAction(s._eval)
+
+        # define expression, based on expression operand and
+        # list of operations in precedence order
+        s.boolExpr = infixNotation(s.boolOperand,
+            [
+            ("not", 1, opAssoc.RIGHT, PyparsingBoolParser.BoolNot),
+            ("and", 2, opAssoc.LEFT,  PyparsingBoolParser.BoolAnd),
+            ("or",  2, opAssoc.LEFT,  PyparsingBoolParser.BoolOr),
+            ])
+
+    def parseString(s, string, print_repr=False):
+        return s.boolExpr.parseString(string)
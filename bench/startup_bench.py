@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+#
+# Measures pyjam startup (parsing) time of a generated tree of buildfiles,
+# with a cold (empty) and a warm bytecode cache.
+#
+# usage: bench/startup_bench.py [-n buildfiles] [-l lines] [-r runs] [dir]
+#
+
+import argparse
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+pyjam = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "pyjam.py")
+
+buildfile = '''\
+m = Module("mod%(i)i")
+m.uses(["mod%(prev)i"])
+m.add_defines(["MOD%(i)i_OPTION=1"])
+'''
+
+def generate(basedir, n, lines):
+    with open(os.path.join(basedir, "project.py"), "w") as f:
+        print("BuildContext.init('bench')", file=f)
+        print("Module.init_context()", file=f)
+        for i in range(n):
+            print("subinclude('mod%i')" % i, file=f)
+        print("BuildContext.finalize()", file=f)
+
+    for i in range(n):
+        moddir = os.path.join(basedir, "mod%i" % i)
+        os.makedirs(moddir, exist_ok=True)
+        with open(os.path.join(moddir, "mod%i.c" % i), "w") as f:
+            print("int mod%i(void) { return %i; }" % (i, i), file=f)
+        with open(os.path.join(moddir, "build.py"), "w") as f:
+            f.write(buildfile % { "i" : i, "prev" : max(i-1, 0) })
+            # some bulk, so compiling the buildfile isn't free
+            for j in range(lines):
+                print("def helper_%i(x):\n    return [x + %i for x in range(%i)]" % (j, j, j), file=f)
+
+def run(basedir):
+    before = time.perf_counter()
+    output = subprocess.check_output([sys.executable, pyjam, "-d", "times", "-Q"], cwd=basedir,
+            universal_newlines=True)
+    total = time.perf_counter() - before
+    parsing = float(re.search(r"parsing took ([0-9.]+)s", output).group(1))
+    return total, parsing
+
+def main():
+    parser = argparse.ArgumentParser(description='pyjam startup benchmark')
+    parser.add_argument('-n', type=int, default=500, help='number of buildfiles')
+    parser.add_argument('-l', type=int, default=20, help='extra lines per buildfile')
+    parser.add_argument('-r', type=int, default=3, help='runs per measurement')
+    parser.add_argument('dir', nargs='?', help='where to generate the tree (default: temporary)')
+    args = parser.parse_args()
+
+    basedir = args.dir or tempfile.mkdtemp(prefix="pyjam-bench-")
+    generate(basedir, args.n, args.l)
+
+    cache = os.path.join(basedir, ".pyjam", "bytecode")
+    print("%i buildfiles in %s" % (args.n, basedir))
+
+    for label, cold in (("cold", True), ("warm", False)):
+        results = []
+        for i in range(args.r):
+            if cold:
+                shutil.rmtree(cache, ignore_errors=True)
+            results.append(run(basedir))
+        total, parsing = min(results)
+        print("%s cache: total %.3fs parsing %.3fs" % (label, total, parsing))
+
+    if not args.dir:
+        shutil.rmtree(basedir)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+#
+# pyjam benchmark suite. Generates synthetic projects (see generate.py) and
+# measures, using "-d times", parsing, bind_targets(), select_wanted() and
+# build_targets(), for a full build (with stub compiler / linker) and a
+# null build.
+#
+# Results are written as one JSON object per line, tagged with the current
+# pyjam commit, so runs on different commits can be compared.
+#
+# usage: bench/suite.py [--preset name ...] [-j jobs] [-o results.jsonl]
+#
+
+import argparse
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+benchdir = os.path.dirname(os.path.abspath(__file__))
+pyjam = os.path.join(os.path.dirname(benchdir), "pyjam.py")
+
+sys.path.insert(0, benchdir)
+import generate
+
+# modules, sources per module, examples, boards
+presets = {
+    "small"  : (20,  2, 2,   2),
+    "medium" : (100, 4, 10,  4),
+    "large"  : (250, 4, 25,  10),
+    "huge"   : (250, 4, 100, 10),   # ~1M targets
+}
+
+patterns = {
+    "parse"         : r"parsing took ([0-9.]+)s",
+    "bind_targets"  : r"binding: ([0-9.]+)",
+    "select_wanted" : r"select_wanted: ([0-9.]+)s",
+    "build_targets" : r"times: .* building: ([0-9.]+)s",
+    "building"      : r"building took ([0-9.]+)s",
+    "updated"       : r"updated ([0-9]+) target",
+}
+
+def commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                cwd=benchdir, stderr=subprocess.DEVNULL, universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(basedir, jobs):
+    before = time.perf_counter()
+    output = subprocess.check_output([sys.executable, pyjam, "-j", str(jobs), "-d", "times"],
+            cwd=basedir, universal_newlines=True)
+    res = { "total" : round(time.perf_counter() - before, 3) }
+    for name, pattern in patterns.items():
+        match = re.search(pattern, output)
+        if match:
+            res[name] = (int if name == "updated" else float)(match.group(1))
+    return res
+
+def main():
+    parser = argparse.ArgumentParser(description='pyjam benchmark suite')
+    parser.add_argument('--preset', action="append", choices=sorted(presets),
+            help='project size(s) to run (default: small, medium)')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('-o', '--output', help='append results to this file (default: stdout)')
+    parser.add_argument('--keep', action="store_true", help='keep generated projects')
+    args = parser.parse_args()
+
+    rev = commit()
+    out = open(args.output, "a") if args.output else sys.stdout
+
+    for preset in args.preset or ["small", "medium"]:
+        modules, sources, examples, boards = presets[preset]
+        basedir = tempfile.mkdtemp(prefix="pyjam-suite-%s-" % preset)
+        generate.generate(basedir, modules, sources, examples, boards, stub=True)
+
+        for kind in ("full", "null"):
+            res = {
+                "commit" : rev,
+                "preset" : preset,
+                "modules" : modules,
+                "sources" : sources,
+                "examples" : examples,
+                "boards" : boards,
+                "jobs" : args.jobs,
+                "build" : kind,
+            }
+            res.update(run(basedir, args.jobs))
+            print(json.dumps(res, sort_keys=True), file=out)
+            out.flush()
+
+        if args.keep:
+            print("kept %s" % basedir, file=sys.stderr)
+        else:
+            shutil.rmtree(basedir)
+
+if __name__ == '__main__':
+    main()
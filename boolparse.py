@@ -1,84 +1,152 @@
 #
-# simpleBool.py
+# boolparse.py
 #
-# Example of defining a boolean logic parser using
-# the operatorGrammar helper method in pyparsing.
+# Parser for the boolean expressions used by Module.use_if(), e.g.,
+# "uart and not (spi or i2c)". Operators are "not", "and" and "or" (in that
+# order of precedence), operands get evaluated using the eval_func given to
+# BoolParser().
 #
-# In this example, parse actions associated with each
-# operator expression will "compile" the expression
-# into BoolXXX class instances, which can then
-# later be evaluated for their boolean value.
-#
-# Copyright 2006, by Paul McGuire
-# Updated 2013-Sep-14 - improved Python 2/3 cross-compatibility
+# Expressions are compiled into nested closures once and memoized by
+# expression string, so evaluating a condition again only costs the
+# eval_func calls.
 #
+
+import re
+
+class BoolParseException(Exception):
+    def __init__(s, string, reason):
+        s.string = string
+        s.reason = reason
+        super().__init__(s)
+
+    def __str__(s):
+        return "BoolParseException: %s in \"%s\"." % (s.reason, s.string)
+
+class BoolExpr(object):
+    def __init__(s, func, text, labels):
+        s.func = func
+        s.text = text
+        s._labels = labels
+
+    def __bool__(s):
+        return s.func()
+
+    def labels(s):
+        return iter(s._labels)
+
+    def __str__(s):
+        return s.text
+    __repr__ = __str__
+
+def _all(funcs):
+    def _and():
+        for func in funcs:
+            if not func():
+                return False
+        return True
+    return _and
+
+def _any(funcs):
+    def _or():
+        for func in funcs:
+            if func():
+                return True
+        return False
+    return _or
+
+def _not(func):
+    return lambda: not func()
+
 class BoolParser(object):
-    from pyparsing import infixNotation, opAssoc, Keyword, Word, alphas, ParserElement, Regex
-
-    # define classes to be built at parse time, as each matching
-    # expression type is parsed
-    class BoolOperand(object):
-        def __init__(self, t, eval_func=eval):
-            self.label = t[0]
-            self.func = eval_func
-        def __bool__(self):
-            return self.func(self.label)
-        def __str__(self):
-            return self.label
-        __repr__ = __str__
-        __nonzero__ = __bool__
-
-    class BoolBinOp(object):
-        def __init__(self,t):
-            self.args = t[0][0::2]
-        def __str__(self):
-            sep = " %s " % self.reprsymbol
-            return "(" + sep.join(map(str,self.args)) + ")"
-        def __bool__(self):
-            return self.evalop(bool(a) for a in self.args)
-        __nonzero__ = __bool__
-        __repr__ = __str__
-
-    class BoolAnd(BoolBinOp):
-        reprsymbol = '&'
-        evalop = all
-
-    class BoolOr(BoolBinOp):
-        reprsymbol = '|'
-        evalop = any
-
-    class BoolNot(object):
-        def __init__(self,t):
-            self.arg = t[0][1]
-        def __bool__(self):
-            v = bool(self.arg)
-            return not v
-        def __str__(self):
-            return "~" + str(self.arg)
-        __repr__ = __str__
-        __nonzero__ = __bool__
-
-    def _eval(s, *args):
-        return BoolParser.BoolOperand(*(args + (s.eval_func,)))
+    _token_re = re.compile(r'\s*(?:([()])|([\w>=]+))')
+    _keywords = { "not", "and", "or" }
 
     def __init__(s, eval_func=eval):
         s.eval_func = eval_func
-        #TRUE = BoolParser.Keyword("True")
-        #FALSE = BoolParser.Keyword("False")
-        #s.boolOperand = TRUE | FALSE | BoolParser.Word(BoolParser.alphas,max=1)
-        #s.boolOperand = BoolParser.Word(BoolParser.alphas,max=1)
-        s.boolOperand = BoolParser.Regex('[\w>=0-9]+')
-        s.boolOperand.setParseAction(s._eval)
-        #BoolParser.ParserElement.enablePackrat()
-
-        # define expression, based on expression operand and
-        # list of operations in precedence order
-        s.boolExpr = BoolParser.infixNotation(s.boolOperand,
-            [
-            ("not", 1, BoolParser.opAssoc.RIGHT, BoolParser.BoolNot),
-            ("and", 2, BoolParser.opAssoc.LEFT,  BoolParser.BoolAnd),
-            ("or",  2, BoolParser.opAssoc.LEFT,  BoolParser.BoolOr),
-            ])
-
-    def parseString(s, string, print_repr=False):
-        return s.boolExpr.parseString(string)
+        s.cache = {}
+
+    def tokenize(s, string):
+        tokens = []
+        pos = 0
+        end = len(string.rstrip())
+        while pos < end:
+            match = BoolParser._token_re.match(string, pos)
+            if not match:
+                raise BoolParseException(string, "unexpected character at position %i" % pos)
+            tokens.append(match.group(1) or match.group(2))
+            pos = match.end()
+        return tokens
+
+    def parse(s, string):
+        expr = s.cache.get(string)
+        if expr is not None:
+            return expr
+
+        s._string = string
+        s._tokens = s.tokenize(string)
+        s._pos = 0
+        s._labels = []
+
+        func, text = s._parse_or()
+        if s._pos != len(s._tokens):
+            raise BoolParseException(string, "unexpected \"%s\"" % s._tokens[s._pos])
+
+        expr = BoolExpr(func, text, s._labels)
+        s.cache[string] = expr
+        return expr
+
+    def parseString(s, string):
+        return [s.parse(string)]
+
+    def _peek(s):
+        if s._pos < len(s._tokens):
+            return s._tokens[s._pos]
+
+    def _next(s):
+        token = s._peek()
+        if token is None:
+            raise BoolParseException(s._string, "unexpected end of expression")
+        s._pos += 1
+        return token
+
+    def _parse_binop(s, keyword, parse_operand, combine, symbol):
+        funcs = []
+        texts = []
+        while True:
+            func, text = parse_operand()
+            funcs.append(func)
+            texts.append(text)
+            if s._peek() != keyword:
+                break
+            s._pos += 1
+
+        if len(funcs) == 1:
+            return funcs[0], texts[0]
+        return combine(funcs), "(" + (" %s " % symbol).join(texts) + ")"
+
+    def _parse_or(s):
+        return s._parse_binop("or", s._parse_and, _any, "|")
+
+    def _parse_and(s):
+        return s._parse_binop("and", s._parse_not, _all, "&")
+
+    def _parse_not(s):
+        if s._peek() == "not":
+            s._pos += 1
+            func, text = s._parse_not()
+            return _not(func), "~" + text
+        return s._parse_atom()
+
+    def _parse_atom(s):
+        token = s._next()
+        if token == "(":
+            res = s._parse_or()
+            if s._next() != ")":
+                raise BoolParseException(s._string, "missing \")\"")
+            return res
+        if token == ")" or token in BoolParser._keywords:
+            raise BoolParseException(s._string, "unexpected \"%s\"" % token)
+
+        eval_func = s.eval_func
+        s._labels.append(token)
+        return (lambda: eval_func(token)), token
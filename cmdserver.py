@@ -23,6 +23,7 @@ class CmdHandle(object):
 
     def wait(s):
         res = s.queue.get()
+        s.pool.running.discard(s)
         s.pool.append(s.server)
         return res
 
@@ -46,7 +47,15 @@ class CmdServer(object):
             args, kwargs = inQueue.get()
             kwargs["stderr"] = STDOUT
             kwargs["stdout"] = PIPE
-            process = Popen(*args, **kwargs)
+            # own process group, so the command can be killed with all its children
+            kwargs.setdefault("start_new_session", True)
+            try:
+                process = Popen(*args, **kwargs)
+            except OSError as e:
+                # e.g., command not found (without shell)
+                outQueue.put(None)
+                outQueue.put(("%s: %s\n" % (e.filename, e.strerror), 127))
+                continue
             outQueue.put(process.pid)
             output = u""
             with process:
@@ -61,9 +70,15 @@ class CmdServer(object):
     def killCmdHostProcess(s):
         s.cmdHostProcess.terminate()
 
+class ServerDeque(deque):
+    # deque of idle servers, also knowing the handles of running commands
+    def __init__(s):
+        super().__init__()
+        s.running = set()
+
 class CmdServerPool(object):
     def __init__(s, n):
-        s.pool = deque()
+        s.pool = ServerDeque()
         for i in range(0, n):
             s.pool.append(CmdServer(s.pool))
 
@@ -74,4 +89,17 @@ class CmdServerPool(object):
     def runcmd(s, *args, **kwargs):
         server = s.pool.pop()
         queue, pid = server.runcmd(*args, **kwargs)
-        return CmdHandle(queue, pid, s.pool, server)
+        handle = CmdHandle(queue, pid, s.pool, server)
+        s.pool.running.add(handle)
+        return handle
+
+    def kill_all(s, signal=signal.SIGKILL):
+        # kills the process groups of all running commands. Unlike
+        # CmdHandle.kill(), this doesn't wait(), the caller of runcmd() does.
+        for handle in list(s.pool.running):
+            if not handle.pid:
+                continue
+            try:
+                os.killpg(handle.pid, signal)
+            except ProcessLookupError:
+                pass
@@ -0,0 +1,94 @@
+#
+# includescan.py
+#
+# A simple C preprocessor #include scanner, used to know header dependencies
+# of sources that were never compiled (so no .d file exists, yet).
+#
+# All #include directives are followed (conditionals are ignored), so the
+# result may contain more headers than the compiler would actually read.
+# Headers that cannot be found in the search path (e.g., system headers) are
+# skipped, just like gcc's -MMD does.
+#
+# Everything is cached: the directives of each file, the resolution of
+# each directive for a given search path, and the transitive headers of
+# each header, so scanning many sources including the same headers is cheap.
+#
+
+import os
+import re
+
+class IncludeScanner(object):
+    _include_re = re.compile(rb'^[ \t]*#[ \t]*include[ \t]*([<"])([^>"\r\n]+)[>"]', re.M)
+
+    def __init__(s, exists=os.path.isfile):
+        s.exists = exists
+        s._directives = {}
+        s._resolved = {}
+        s._closures = {}
+
+    def directives(s, path):
+        res = s._directives.get(path)
+        if res is None:
+            try:
+                with open(path, "rb") as f:
+                    data = f.read()
+                res = [ (kind == b'"', name.decode("utf-8", "replace").strip())
+                        for kind, name in IncludeScanner._include_re.findall(data) ]
+            except OSError:
+                res = []
+            s._directives[path] = res
+        return res
+
+    def resolve(s, quoted, name, current_dir, paths):
+        key = (quoted and current_dir, name, paths)
+        try:
+            return s._resolved[key]
+        except KeyError:
+            pass
+
+        res = None
+        for dir in ([current_dir] if quoted else []) + list(paths):
+            path = os.path.normpath(os.path.join(dir, name))
+            if s.exists(path):
+                res = path
+                break
+
+        s._resolved[key] = res
+        return res
+
+    def direct(s, path, paths):
+        res = []
+        current_dir = os.path.dirname(path)
+        for quoted, name in s.directives(path):
+            header = s.resolve(quoted, name, current_dir, paths)
+            if header:
+                res.append(header)
+        return res
+
+    def closure(s, header, paths):
+        # all headers (transitively) included by header
+        key = (header, paths)
+        res = s._closures.get(key)
+        if res is None:
+            res = []
+            seen = { header }
+            stack = [header]
+            while stack:
+                for dep in s.direct(stack.pop(), paths):
+                    if not dep in seen:
+                        seen.add(dep)
+                        res.append(dep)
+                        stack.append(dep)
+            s._closures[key] = res
+        return res
+
+    def scan(s, source, paths):
+        paths = tuple(paths)
+        res = []
+        seen = set()
+        for header in s.direct(source, paths):
+            for dep in [header] + s.closure(header, paths):
+                if not dep in seen:
+                    seen.add(dep)
+                    res.append(dep)
+        return res
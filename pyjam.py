@@ -2,14 +2,26 @@
 
 import argparse
 import copy
+import cProfile
+import fnmatch
 import glob
+import hashlib
+import importlib.util
+import marshal
 import os
+import pickle
 import pprint
+import pstats
+import re
+import shutil
+import signal
 import subprocess
 import sys
 import traceback
 import cmdserver
+import query
 import time
+import tracemalloc
 
 from os.path import abspath, dirname, basename
 import threading
@@ -27,12 +39,17 @@ _wanted_names = []
 
 # housekeeping for created files and directories
 _created_files = set()
-_created_dirs = set()
-_existing_files = set() # files that pre-existed in directories pyjam tried to create
 _dir_exists = set()
 _clean_leftovers = False
 _clean = False
 
+# persistent state (caches etc.), relative to _basedir
+_state_dir = ".pyjam"
+
+# directory listing cache, maps absolute path to (mtime_ns, scan time, files)
+_dir_cache = None
+_dir_cache_dirty = False
+
 # debug options
 _debug_levels = { 'error', 'warning', 'default' }
 _valid_debug_levels = {'binding', 'clean', 'include', 'targets', 'depends', 'exports', 'env', 'threads', 'verbose', 'needed', 'context', 'locate', 'cause', 'commands', 'phases', 'warning', 'error', 'debug', 'times'}
@@ -48,6 +65,13 @@ _global_var_unexports = set()
 # subshell defaults
 _shell_options = ["-e"]
 
+# commands without these (apart from $VAR / ${VAR}) are run without a shell
+_shell_chars = set("|&;<>()$`\\\"'*?[]{}#~!\n")
+_shell_builtins = { ".", ":", "alias", "break", "case", "cd", "continue", "eval", "exec", "exit",
+        "export", "for", "if", "read", "readonly", "return", "set", "shift", "source", "trap",
+        "ulimit", "umask", "unset", "until", "wait", "while" }
+_command_token = re.compile(r"([ \t]+)|'([^']*)'|\$\{(\w+)\}|\$(\w+)|([^ \t'$]+)|(.)", re.S)
+
 # shell environment
 _original_env = os.environ.copy()
 
@@ -56,6 +80,7 @@ _included_set = set()
 _include_stack = []
 _cwd_stack = []
 _include_cache = {}
+_included_by = {} # buildfile -> buildfiles including it
 
 _globals = globals()
 
@@ -77,9 +102,34 @@ _start_cwd = None
 _prio = 0
 _build_queue = None
 
+# functions called after parsing, before binding targets
+_post_parse = []
+
 # ForkServer
 _cmd_server_pool = None
 
+# per-phase profiling (--profile)
+_profiler = None
+
+# build durations of targets (persistent), used for progress / ETA
+_durations = {}
+_durations_dirty = False
+_progress = None
+
+# targets that failed in the previous build(s) (persistent), built first
+_failed = set()
+_failed_dirty = False
+# set if any target failed to build in this run
+_build_failed = False
+
+# content hashes of built outputs, for early cutoff
+_output_hashes = {}
+_output_hashes_dirty = False
+
+# identical actions (e.g., compiles shared by multiple contexts) built in this run
+_shared_actions = {}
+_shared_actions_lock = threading.Lock()
+
 class StartedInSubdirException(Exception):
     def __init__(s):
         super().__init__()
@@ -127,6 +177,14 @@ def list_remove_all(target, remove):
 
 class Context(object):
     i=0
+    # once frozen (after parsing), variable lookups are served from flat
+    # per-context tables. Any later change to a context bumps _generation,
+    # which invalidates all tables.
+    _frozen = False
+    _generation = 0
+    # workers resolve concurrently, tables get (re)created under this lock
+    _lock = threading.Lock()
+
     def __init__(s, name=None, parents=None):
         s._name = name # "(%i)%s" % (Context.i, name)
         Context.i+=1
@@ -138,8 +196,13 @@ class Context(object):
 
     def __setattr__(s, name, value):
         if name.startswith("_"):
+            if name == "_parents":
+                for parent in value:
+                    parent.__dict__["_has_children"] = True
+                Context._generation += 1
             s.__dict__[name] = value
         else:
+            Context._generation += 1
             if isinstance(value, Var):
                 s._fields[name] = copy.deepcopy(value)
                 return
@@ -152,9 +215,17 @@ class Context(object):
             else:
                 var.set(value)
 
+    def add_parent(s, parent):
+        if not parent in s._parents:
+            parent.__dict__["_has_children"] = True
+            s._parents.append(parent)
+            Context._generation += 1
+
     def __getattr__(s, name, visited=None):
         if name.startswith("_"):
             return s.__dict__.get(name)
+        if Context._frozen and not visited:
+            return s._resolve(name)
         visited = visited or set()
         if s in visited:
             return None
@@ -170,6 +241,77 @@ class Context(object):
 
         return var
 
+    def freeze():
+        Context._frozen = True
+        Context._generation += 1
+
+    def _linearize(s):
+        # Post-order of all ancestors as visited by the recursive lookup,
+        # each with the index where the block of contexts reached through it
+        # starts (needed to cut off inheritance for Var(inherit=False)).
+        linear = []
+        visited = { s }
+        stack = [(s, 0, 0)]
+        while stack:
+            context, i, start = stack.pop()
+            if i < len(context._parents):
+                stack.append((context, i+1, start))
+                parent = context._parents[i]
+                if not parent in visited:
+                    visited.add(parent)
+                    stack.append((parent, 0, len(linear)))
+            else:
+                linear.append((context, start))
+        return linear
+
+    def _tables(s):
+        # (generation, resolved vars, linearized ancestors) of this context.
+        # Replaced as a whole, so other threads never see a half reset table.
+        tables = s._table
+        if tables is None or tables[0] != Context._generation:
+            with Context._lock:
+                tables = s._table
+                if tables is None or tables[0] != Context._generation:
+                    tables = (Context._generation, {}, [])
+                    s._table = tables
+        return tables
+
+    def _resolve(s, name):
+        generation, resolved, linear = s._tables()
+
+        var = resolved.get(name)
+        if var:
+            return var
+
+        field = s._fields.get(name)
+        if not field and len(s._parents) == 1 and not s._has_children:
+            # e.g. rule contexts, share the parent's table
+            var = s._parents[0]._resolve(name)
+        else:
+            if not linear:
+                with Context._lock:
+                    if not linear:
+                        linear.extend(s._linearize())
+
+            combined = []
+            lengths = []
+            for context, start in linear:
+                lengths.append(len(combined))
+                entry = context._fields.get(name)
+                if entry:
+                    if not entry.inherit:
+                        del combined[lengths[start]:]
+                    combined.extend(entry.list)
+
+            if field:
+                var = Var(combined, field.joiner, field.start)
+            else:
+                var = Var(combined)
+            var.inherit = False
+
+        resolved[name] = var
+        return var
+
     def get(s, name):
         return str(s.__getattr__(name)) or None
 
@@ -213,7 +355,9 @@ class Context(object):
         s._unexports |= set(listify(fields))
 
 class Var(object):
+    i=0
     def __init__(s, initial=None, joiner=None, start=None):
+        Var.i+=1
         if isinstance(initial, Var):
             s.list = initial.list
             s.remove = initial.remove
@@ -389,6 +533,7 @@ class Target(object):
         s.always=False
         s.queued=False
         s.done=False
+        s.unchanged=False
         s.not_file= kwargs.get('no_file') or True
 
         s.actions = []
@@ -479,17 +624,38 @@ class Target(object):
         if s.rebuild:
             pass
         else:
+            cutoff = False
             for dep in s.deps:
                 if dep.check_update():
+                    if dep.unchanged and not dep.mtime > s.mtime:
+                        # rebuilt, but with identical output (early cutoff)
+                        cutoff = True
+                        continue
                     dprint('cause', "rebuilding %s because dependency %s has to be rebuilt." % (s.name, dep.name))
                 elif dep.mtime > s.mtime:
                     dprint('cause', "%s is older than %s (%s < %s). Rebuilding." %( s.name, dep.name, s.mtime, dep.mtime))
                 else:
+                    if dep.unchanged:
+                        # kept (and touched) because of early cutoff, keep
+                        # this one as well so it stays newer than dep
+                        cutoff = True
                     continue
                 s.rebuild=True
                 break
+            if cutoff and not s.rebuild and not s.unchanged:
+                dprint('cause', "not rebuilding %s, rebuilt dependencies did not change." % s.name)
+                s.unchanged = True
         return s.rebuild
 
+    def keep(s):
+        pass
+
+    def record_output(s):
+        pass
+
+    def output_dirs(s):
+        return []
+
     def build(s):
             try:
                 actions = s.actions
@@ -615,34 +781,143 @@ class FileTarget(Target):
 
         return s.rebuild
 
+    def output_dirs(s):
+        if s.actions:
+            return [ os.path.dirname(s.name) ]
+        return []
+
+    def keep(s):
+        # Skipped because of early cutoff. Make the file newer than its
+        # rebuilt dependencies, so the next run sees it as up to date. Its
+        # dependents get kept (and touched) as well, see check_update().
+        try:
+            os.utime(s.name)
+        except OSError:
+            pass
+
+    def record_output(s):
+        global _output_hashes_dirty
+        try:
+            with open(s.name, "rb") as f:
+                digest = hashlib.sha1(f.read()).digest()
+        except OSError:
+            return
+
+        if _output_hashes.get(s.name) == digest:
+            dprint('cause', "%s did not change." % s.name)
+            s.unchanged = True
+        else:
+            _output_hashes[s.name] = digest
+            _output_hashes_dirty = True
+
 def touch(path):
     with open(path, 'a'):
         os.utime(path, None)
 
+def link_file(src, dst):
+    try:
+        os.unlink(dst)
+    except FileNotFoundError:
+        pass
+    try:
+        os.link(src, dst)
+    except FileNotFoundError:
+        return False
+    except OSError:
+        try:
+            shutil.copy2(src, dst)
+        except OSError:
+            return False
+    return True
+
+def unlink_shared(path):
+    # files hardlinked by link_file() must not be overwritten in place
+    try:
+        if os.stat(path).st_nlink > 1:
+            os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+class SharedAction(object):
+    def __init__(s, target):
+        s.target = target
+        s.result = False
+        s.event = threading.Event()
+
+    def finish(s, result):
+        s.result = result
+        s.event.set()
+
+    def wait(s):
+        s.event.wait()
+        return s.result
+
+def claim_action(key, target):
+    with _shared_actions_lock:
+        shared = _shared_actions.get(key)
+        if shared:
+            return shared, False
+        shared = SharedAction(target)
+        _shared_actions[key] = shared
+        return shared, True
+
 def clean(files):
     global _created_files
     files = listify(files)
     _created_files |= set(files)
 
+def unlink_files(files, what="cleaned"):
+    # unlinks files using multiple threads, returns the number of removed files
+    files = list(files)
+    removed = [ 0 ]
+
+    def unlink(files):
+        n = 0
+        for f in files:
+            try:
+                os.unlink(f)
+                dprint("clean", "...", what, f)
+                n += 1
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                dprint("clean", "... error removing", f, "reason:", e)
+        removed.append(n)
+
+    jobs = min(os.cpu_count() or 1, len(files) // 256 + 1)
+    threads = [ Thread(target=unlink, args=(files[i::jobs],)) for i in range(jobs) ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return sum(removed)
+
 def do_clean():
-    for f in _created_files:
-        try:
-            os.unlink(f)
-            dprint("clean", "... cleaned", f)
-        except Exception:
-            pass
+    unlink_files(_created_files)
 
 def set_clean_leftovers(val=True):
     global _clean_leftovers
     _clean_leftovers = val
 
-def do_clean_leftovers():
-    for f in (_existing_files-_created_files-_created_dirs):
-        try:
-            os.unlink(f)
-            dprint("clean", "... removed leftover file", f)
-        except Exception as e:
-            dprint("clean", "... error removing leftover file", f, "reason:", e)
+def do_clean_leftovers(manifest):
+    # outputs of the previous build that the buildfiles don't declare anymore
+    if manifest:
+        unlink_files(manifest - _created_files, "removed leftover file")
+
+def update_manifest(manifest):
+    # the manifest lists all outputs pyjam creates, so "pyjam -c" doesn't
+    # need to parse buildfiles and leftovers can be found without scanning
+    if manifest != _created_files:
+        save_state("manifest", set(_created_files))
+
+def clean_from_manifest():
+    manifest = load_state("manifest")
+    if manifest is None:
+        return False
+
+    dprint("default", "... cleaned %i file(s) ..." % unlink_files(manifest))
+    return True
 
 def path_split(path):
     res = []
@@ -660,26 +935,80 @@ def path_split(path):
         tmp = os.path.join(tmp, res.pop())
         yield(tmp)
 
-def scan_existing_files(fullpath, relpath):
-    for entry in os.scandir(fullpath):
-        if entry.is_file():
-            _existing_files.add(os.path.join(relpath, entry.name))
+def state_file(name):
+    return os.path.join(_basedir, _state_dir, name)
+
+def load_state(name, default=None):
+    try:
+        with open(state_file(name), "rb") as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        dprint("warning", "warning: ignoring unreadable state file %s (%s)" % (state_file(name), e))
+    return default
+
+def save_state(name, data):
+    path = state_file(name)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "wb") as f:
+            pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(path + ".tmp", path)
+    except OSError as e:
+        dprint("warning", "warning: cannot write state file %s (%s)" % (path, e))
+
+def list_files(dir=None):
+    global _dir_cache, _dir_cache_dirty
+    if _dir_cache is None:
+        _dir_cache = load_state("dircache", {})
+
+    fullpath = os.path.abspath(dir or ".")
+    try:
+        mtime = os.stat(fullpath).st_mtime_ns
+    except OSError:
+        return []
+
+    cached = _dir_cache.get(fullpath)
+    if cached and cached[0] == mtime:
+        return cached[2]
+
+    dprint("include", "Scanning directory \"%s\"." % fullpath)
+    files = [entry.name for entry in os.scandir(fullpath) if entry.is_file()]
+    _dir_cache[fullpath] = (mtime, int(time.time() * 1000000000), files)
+    _dir_cache_dirty = True
+    return files
+
+def glob_files(patterns, dir=None):
+    files = list_files(dir)
+    result = []
+    for pattern in listify(patterns):
+        for name in fnmatch.filter(files, pattern):
+            # like glob(), wildcards don't match hidden files
+            if name.startswith(".") and not pattern.startswith("."):
+                continue
+            result.append(os.path.join(dir, name) if dir else name)
+    return result
+
+def save_dir_cache():
+    if not _dir_cache_dirty:
+        return
+    # a directory that changed within the mtime granularity of its scan
+    # might change again unnoticed, so only persist settled listings
+    settled = {path: entry for path, entry in _dir_cache.items()
+            if entry[1] - entry[0] > 2000000000}
+    save_state("dircache", settled)
 
 def mkdir(dirs, start_dir=None):
     dirs = listify(dirs)
     for d in dirs:
-        path = os.path.relpath(d, _basedir)
-        if path in _dir_exists:
+        if not d or d in _dir_exists:
             continue
-        if os.path.isdir(d):
-            fullpath = os.path.join(_basedir, path)
-            scan_existing_files(fullpath, path)
-        else:
-            try:
-                os.makedirs(d)
-            except Exception as e:
-                print(e)
-        _dir_exists.add(path)
+        try:
+            os.makedirs(d, exist_ok=True)
+        except Exception as e:
+            print(e)
+        _dir_exists.add(d)
 
 def subst_ext(f, new_ext):
     n, ext = os.path.splitext(f)
@@ -697,6 +1026,146 @@ def bind_target(target):
 
     return target
 
+def reachable_targets(names):
+    # all targets the given ones (transitively) depend on, works before binding
+    seen = set()
+    stack = listify(names)[:]
+    while stack:
+        target = _targets.get(str(stack.pop()))
+        if not target or target.name in seen:
+            continue
+        seen.add(target.name)
+        yield target
+        stack.extend(target.deps)
+
+def reverse_dependencies():
+    # target name -> names of the targets depending on it
+    rdeps = {}
+    for name, target in _targets.items():
+        for dep in target.deps:
+            rdeps.setdefault(str(dep), []).append(name)
+    return rdeps
+
+def affected_targets(paths):
+    # All targets that (transitively) depend on the given files, or that were
+    # defined by one of them (or a buildfile included by them), if they are
+    # buildfiles.
+    buildfiles = { abspath(path) for path in paths } & _included_set
+    includes = {}
+    for buildfile, parents in _included_by.items():
+        for parent in parents:
+            includes.setdefault(parent, []).append(buildfile)
+    stack = list(buildfiles)
+    while stack:
+        for buildfile in includes.get(stack.pop(), ()):
+            if not buildfile in buildfiles:
+                buildfiles.add(buildfile)
+                stack.append(buildfile)
+
+    # dependencies from .d files might be absolute paths
+    affected = { path for path in paths + [ abspath(path) for path in paths ] if path in _targets }
+    if buildfiles:
+        for name, target in _targets.items():
+            for action in target.actions:
+                if getattr(action, 'buildfile', None) in buildfiles:
+                    affected.add(name)
+                    break
+
+    rdeps = reverse_dependencies()
+    stack = list(affected)
+    while stack:
+        for name in rdeps.get(stack.pop(), ()):
+            if not name in affected:
+                affected.add(name)
+                stack.append(name)
+
+    return affected
+
+# pyjam's own files, a change in any of them might affect every target
+_own_files = [ "pyjam.py", "rules.py", "boolparse.py", "cmdserver.py", "includescan.py", "query.py" ]
+
+def want_changed(filename):
+    # only build what is affected by the files listed in filename
+    f = sys.stdin if filename == "-" else open(os.path.join(_start_cwd, filename))
+    with f:
+        paths = [ os.path.normpath(os.path.relpath(os.path.join(_start_cwd, line.strip()), _basedir))
+                for line in f if line.strip() ]
+
+    own_dir = dirname(os.path.realpath(__file__))
+    own_files = { os.path.join(own_dir, name) for name in _own_files }
+    for path in paths:
+        if os.path.realpath(os.path.join(_basedir, path)) in own_files:
+            dprint("default", "... %s changed, building everything." % path)
+            return
+
+    wanted = { target.name for target in reachable_targets(_wanted_names) }
+    affected = [ name for name in affected_targets(paths) if name in wanted and _targets[name].actions ]
+
+    dprint("default", "... %i of %i target(s) affected by %i changed file(s)" % (len(affected), len(wanted), len(paths)))
+    _wanted_names[:] = sorted(affected)
+
+def graph_index():
+    # a query.GraphIndex of the (bound) graph
+    deps = {}
+    generated = set()
+    virtual = set()
+    modules = {}
+    binaries = {}
+    for name, target in _targets.items():
+        deps[name] = str_list(target.deps)
+        if target.actions:
+            generated.add(name)
+        if target.not_file:
+            virtual.add(name)
+        for action in target.actions:
+            if hasattr(action, "_uses_hard"):
+                modules[name] = (list(action._uses), sorted(action._uses_hard), action.used)
+            elif hasattr(action, "modules"):
+                binaries[name] = list(action.modules)
+
+    return query.GraphIndex(deps, generated, virtual, modules, binaries)
+
+def buildfiles_changed(buildfiles):
+    for path, mtime in buildfiles.items():
+        try:
+            if os.stat(path).st_mtime_ns != mtime:
+                return True
+        except OSError:
+            return True
+    return False
+
+def run_query(query_args):
+    # Answers a "pyjam query". The index is stored in the state dir and only
+    # recreated (by parsing all buildfiles, without building anything) if a
+    # buildfile changed since.
+    set_basedir()
+
+    cached = load_state("graph")
+    if cached and not query_args.refresh and not buildfiles_changed(cached["buildfiles"]):
+        index, buildfiles = cached["index"], cached["buildfiles"]
+    else:
+        try:
+            include(os.path.join(dirname(os.path.realpath(__file__)), "rules.py"))
+            include("project.py")
+        except Exception as e:
+            traceback.print_exc()
+            clean_exit(1)
+
+        bind_targets()
+        index = graph_index()
+        buildfiles = { path : os.stat(path).st_mtime_ns for path in _included_set }
+        save_state("graph", { "index" : index, "buildfiles" : buildfiles })
+
+    def locate(name):
+        # dependencies from .d files might be absolute paths
+        name = cmdline_target(name)
+        if not name in index and abspath(name) in index:
+            return abspath(name)
+        return name
+
+    newest_buildfile = max(buildfiles.values() or [0]) / 1e9
+    return query.run(index, query_args, locate, newest_buildfile)
+
 def bind_targets():
     global _unbound_targets
     for utarget in _unbound_targets:
@@ -716,10 +1185,28 @@ def start_workers():
             t.daemon = True
             t.start()
 
+def prioritize_failed():
+    # targets that failed last time (and what they depend on) go first,
+    # so it is known quickly whether they have been fixed
+    failed = [ name for name in sorted(_failed) if name in _targets ]
+    if not failed:
+        return
+
+    targets = [ target for target in reachable_targets(failed) if target.prio == -1 ]
+    dprint("verbose", "... prioritizing %i previously failed target(s)" % len(failed))
+
+    # below all regular priorities (and -1, which means "unassigned")
+    prio = -1 - len(targets)
+    for target in targets:
+        target.prio = prio
+        prio += 1
+
 def build_targets(all=True):
     global _prio
     global _build_queue
 
+    prioritize_failed()
+
     for target in _wanted:
         with target.lock:
             if (target.prio==-1):
@@ -747,47 +1234,264 @@ def build_targets(all=True):
 
 def worker(queue, block=False, n=0):
     _thread_local.n = n
-    global _exit_threads
+
+    profile = None
 
     dprint("threads", "%2i: Worker thread started." % n)
-    while not _exit_threads:
+    while True:
         try:
             prio, target = queue.get(block=block)
         except Empty:
             return
 
-        dprint("threads", "%2i: building target %s (prio=%s)" % (n, target.name, prio))
+        if _exit_threads:
+            # build was cancelled, just drain the queue
+            queue.task_done()
+            continue
 
-        target.check_update()
-        success = target.rebuild==False or target.do_build()
-        if not success and args.quit:
+        if _profiler and block:
+            profile = profile or _profiler.worker_profile()
+            if profile:
+                profile.enable()
+
+        try:
+            build_queued(queue, prio, target, n)
+        except Exception:
+            # a dead worker would hang _build_queue.join()
+            traceback.print_exc()
+            cancel_build()
+        finally:
+            if profile:
+                profile.disable()
             queue.task_done()
-            _exit_threads = True
-            try:
-                while queue.get(block=False):
-                    queue.task_done()
-            except Empty:
-                pass
-            return
 
-        target.done = True
-        dprint("threads", "%2i: done building target %s (prio=%s)" % (n, target.name, prio))
+def build_queued(queue, prio, target, n):
+    global _durations_dirty, _failed_dirty, _build_failed
+    dprint("threads", "%2i: building target %s (prio=%s)" % (n, target.name, prio))
+
+    if _progress:
+        _progress.begin(n, target)
+
+    target.check_update()
+    if target.rebuild==False and target.unchanged:
+        target.keep()
+    if target.rebuild:
+        mkdir(target.output_dirs())
+        before = time.time()
+        success = target.do_build()
+        _durations[target.name] = time.time() - before
+        _durations_dirty = True
+    else:
+        success = True
+    if success and target.rebuild:
+        target.record_output()
+
+    if _progress:
+        _progress.end(n, target)
+
+    if not success:
+        _build_failed = True
+        if not _exit_threads:
+            _failed.add(target.name)
+            _failed_dirty = True
+    elif target.name in _failed:
+        _failed.discard(target.name)
+        _failed_dirty = True
+    if not success and args.quit:
+        cancel_build()
+        return
+
+    target.done = True
+    dprint("threads", "%2i: done building target %s (prio=%s)" % (n, target.name, prio))
 
-        for needed_for in target.needed_for:
-            with needed_for.lock:
-                if not success:
-                    needed_for.missing.append(target.name)
-                    if needed_for.is_needed():
-                        _skipped.append((needed_for.name, target))
-                else:
-                    needed_for.ndeps -= 1
-                    if needed_for.prio != -1:
-                        if needed_for.ready_for_building():
-                            dprint("verbose", "%2i: queuing target" % n, needed_for, "(prio=%s)" % needed_for.prio)
-                            needed_for.queued = True
-                            queue.put((needed_for.prio, needed_for))
+    for needed_for in target.needed_for:
+        with needed_for.lock:
+            if not success:
+                needed_for.missing.append(target.name)
+                if needed_for.is_needed():
+                    _skipped.append((needed_for.name, target))
+            else:
+                needed_for.ndeps -= 1
+                if needed_for.prio != -1:
+                    if needed_for.ready_for_building():
+                        dprint("verbose", "%2i: queuing target" % n, needed_for, "(prio=%s)" % needed_for.prio)
+                        needed_for.queued = True
+                        queue.put((needed_for.prio, needed_for))
+
+def cancel_build(reason="build failed"):
+    # stop scheduling and kill all commands that are still running
+    global _exit_threads
+    if not _exit_threads:
+        _exit_threads = True
+        dprint("default", "... %s, cancelling running jobs ..." % reason)
+    _cmd_server_pool.kill_all()
+
+def interrupted(signum, frame):
+    # Commands run in their own session (so they can be killed with their
+    # children), which means the terminal's SIGINT doesn't reach them.
+    cancel_build("interrupted")
+    raise KeyboardInterrupt
+
+def build_cancelled():
+    return _exit_threads
+
+class Progress(object):
+    # Periodically prints done/queued/running counts and an ETA from a
+    # separate thread. Workers only write into their own slots, so no
+    # locking is needed.
+    def __init__(s, jobs, interval):
+        s.jobs = jobs
+        s.interval = interval
+        s.running = [ None ] * jobs
+        s.done = [ 0 ] * jobs
+        s.work = [ 0.0 ] * jobs
+        s.tails = {}
+        s.estimate = {}
+        s.total = 0
+        s.total_work = 0.0
+        s.stop = threading.Event()
+
+    def begin(s, n, target):
+        s.running[n] = (target, time.time())
+
+    def end(s, n, target):
+        s.running[n] = None
+        s.done[n] += 1
+        s.work[n] += s.estimate.get(target.name, 0)
+
+    def start(s, wanted):
+        # post-order, so all dependencies of a target come before it
+        order = []
+        seen = set()
+        stack = [ (target, False) for target in wanted ]
+        while stack:
+            target, expanded = stack.pop()
+            if expanded:
+                order.append(target)
+            elif not target in seen:
+                seen.add(target)
+                stack.append((target, True))
+                stack.extend((dep, False) for dep in target.deps if not dep in seen)
+
+        known = [ _durations[target.name] for target in order if target.actions and target.name in _durations ]
+        s.default = known and sum(known) / len(known)
+        s.have_history = bool(known)
+
+        # tail: duration of the longest chain from a target up to a wanted one
+        for target in reversed(order):
+            duration = _durations.get(target.name, target.actions and s.default or 0)
+            s.estimate[target.name] = duration
+            s.total_work += duration
+            tail = 0
+            for parent in target.needed_for:
+                tail = max(tail, s.tails.get(parent, 0))
+            s.tails[target] = duration + tail
+
+        s.total = len(order)
+        Thread(target=s.run, daemon=True).start()
+
+    def eta(s, now, running):
+        if not s.have_history:
+            return "?"
+        critical = 0
+        work = s.total_work - sum(s.work)
+        for target, started in running:
+            critical = max(critical, s.tails.get(target, 0) - (now - started))
+            work -= min(now - started, s.estimate.get(target.name, 0))
+        for prio, target in list(_build_queue.queue):
+            critical = max(critical, s.tails.get(target, 0))
+        left = max(critical, work / s.jobs, 0)
+        return "%i:%02i" % (left // 60, left % 60)
+
+    def report(s):
+        now = time.time()
+        running = [ job for job in s.running if job ]
+        dprint("default", "... progress: %i/%i done, %i queued, %i running, ETA %s" %
+                (sum(s.done), s.total, _build_queue.qsize(), len(running), s.eta(now, running)))
+        for n, job in enumerate(s.running):
+            if job and now - job[1] > s.interval:
+                dprint("default", "...   %2i: %s (%.0fs)" % (n, job[0].name, now - job[1]))
+
+    def run(s):
+        while not s.stop.wait(s.interval):
+            s.report()
+
+class PhaseProfiler(object):
+    # Writes a cProfile stats file and a tracemalloc snapshot per phase.
+    # Phases may nest (e.g., hooks run during parsing), the outer phase's
+    # profile is paused meanwhile.
+    def __init__(s, outdir):
+        s.outdir = outdir
+        s.stack = []
+        s.profiles = {}
+        s.worker_profiles = []
+        s.lock = threading.Lock()
+
+        os.makedirs(outdir, exist_ok=True)
+        tracemalloc.start()
+
+    def enter(s, phase):
+        if s.stack:
+            s.profiles[s.stack[-1]].disable()
+        s.stack.append(phase)
+        s.profiles.setdefault(phase, cProfile.Profile()).enable()
+
+    def leave(s):
+        phase = s.stack.pop()
+        s.profiles[phase].disable()
+        tracemalloc.take_snapshot().dump(os.path.join(s.outdir, phase + ".tracemalloc"))
+        if s.stack:
+            s.profiles[s.stack[-1]].enable()
+
+    def worker_profile(s):
+        # Since python 3.12, cProfile uses sys.monitoring: only one profile
+        # can be active, and the "building" phase's one sees all threads.
+        if sys.version_info >= (3, 12):
+            return None
+        profile = cProfile.Profile()
+        with s.lock:
+            s.worker_profiles.append(profile)
+        return profile
+
+    def finish(s):
+        while s.stack:
+            s.leave()
+
+        for phase, profile in s.profiles.items():
+            profiles = [ profile ]
+            if phase == "building":
+                profiles.extend(s.worker_profiles)
+
+            stats = None
+            for profile in profiles:
+                try:
+                    if stats:
+                        stats.add(profile)
+                    else:
+                        stats = pstats.Stats(profile)
+                except TypeError:
+                    # profile without any calls
+                    pass
+            if stats:
+                stats.dump_stats(os.path.join(s.outdir, phase + ".pstats"))
+
+        current, peak = tracemalloc.get_traced_memory()
+        edges = 0
+        for target in _targets.values():
+            edges += len(target.deps)
+
+        print("... profile: peak memory %.1fMiB, %i targets, %i edges, %i contexts, %i Vars" %
+                (peak / 1048576, len(_targets), edges, Context.i, Var.i))
+        print("... profile: wrote per-phase .pstats and .tracemalloc files to %s" % s.outdir)
+
+def profile_enter(phase):
+    dprint("phases", "... entering %s phase ..." % phase)
+    if _profiler:
+        _profiler.enter(phase)
 
-        queue.task_done()
+def profile_leave():
+    if _profiler:
+        _profiler.leave()
 
 def filter_vars(targets):
     _tmp = targets.copy()
@@ -802,14 +1506,89 @@ def filter_vars(targets):
     if not _clean and not targets:
         targets.append("all")
 
+def parse_shard(text):
+    try:
+        shard, count = [ int(x) for x in text.split("/") ]
+        if 1 <= shard <= count:
+            return (shard - 1, count)
+    except ValueError:
+        pass
+    raise argparse.ArgumentTypeError("expected i/N with 1 <= i <= N, got \"%s\"" % text)
+
+def shard_wanted(shard, count, durations=None):
+    # Splits the wanted targets into count shards of about equal cost and
+    # keeps only shard's part. Virtual targets (like "all") are replaced by
+    # what they depend on. Each unit goes to the shard where it adds the
+    # least, taking into account dependencies already built there.
+    #
+    # All runners have to compute the same partition, so costs must not
+    # depend on local state: by default, they are source counts. durations
+    # (e.g., from a file shared by all runners) are used where known.
+    durations = durations or {}
+    units = []
+    seen = set()
+    stack = list(reversed(_wanted_names))
+    while stack:
+        name = stack.pop()
+        target = _targets.get(name)
+        if name in seen or not target:
+            continue
+        seen.add(name)
+        if not target.actions and target.deps:
+            stack.extend(reversed(str_list(target.deps)))
+        else:
+            units.append(name)
+
+    # cost: known duration, or the number of sources
+    per_source = []
+    for name, duration in durations.items():
+        target = _targets.get(name)
+        sources = target and sum(len(getattr(action, 'sources', ())) for action in target.actions)
+        if sources:
+            per_source.append(duration / sources)
+    per_source = per_source and sum(per_source) / len(per_source) or 1
+
+    costs = {}
+    def cost(target):
+        res = costs.get(target.name)
+        if res is None:
+            res = durations.get(target.name)
+            if res is None:
+                res = per_source * sum(len(getattr(action, 'sources', ())) for action in target.actions)
+            costs[target.name] = res
+        return res
+
+    closures = {}
+    for unit in units:
+        closures[unit] = { target.name : cost(target) for target in reachable_targets(unit) }
+
+    shards = [ (set(), []) for i in range(count) ]
+    loads = [ 0 ] * count
+    for unit in sorted(units, key=lambda unit: (-sum(closures[unit].values()), unit)):
+        closure = closures[unit]
+        added = [ sum(c for name, c in closure.items() if not name in shards[i][0]) for i in range(count) ]
+        best = min(range(count), key=lambda i: (loads[i] + added[i], i))
+        shards[best][0].update(closure)
+        shards[best][1].append(unit)
+        loads[best] += added[best]
+
+    dprint("default", "... shard %i/%i: %i of %i target(s), cost %.1f of %.1f" %
+            (shard + 1, count, len(shards[shard][1]), len(units), loads[shard], sum(loads)))
+
+    _wanted_names[:] = sorted(shards[shard][1])
+
+def cmdline_target(target_name):
+    # target names given on the command line are relative to where pyjam
+    # was started
+    if _start_cwd != os.getcwd():
+        target_name = os.path.join(os.path.relpath(_start_cwd, _basedir), target_name)
+
+    return os.path.normpath(target_name)
+
 def want_targets(targets):
     targets = listify(targets)
     for target_name in targets:
-        if _start_cwd != os.getcwd():
-            target_name = os.path.join(os.path.relpath(_start_cwd, _basedir), target_name)
-
-        target_name = os.path.normpath(target_name)
-        _wanted_names.append(target_name)
+        _wanted_names.append(cmdline_target(target_name))
 
 def select_wanted(set_stable=False):
     for target_name in _wanted_names:
@@ -834,8 +1613,9 @@ def select_wanted(set_stable=False):
         except KeyError:
             print("unkown target", target_name)
 
-def parse_args():
-    parser = argparse.ArgumentParser(prog='pyjam', description='A pythonic build system.')
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='pyjam', description='A pythonic build system.',
+            epilog='Use "pyjam query --help" for querying the dependency graph.')
 
     parser.add_argument('targets', metavar='target', type=str, nargs='*',
             help='targets to build (default: all)', default=[])
@@ -848,8 +1628,17 @@ def parse_args():
     parser.add_argument('-q', "--quit", help='stop on first error', action="store_true" )
     parser.add_argument('-d', "--debug", help='enable specific debug output', action="append", choices=_valid_debug_levels, metavar="{x}" )
     parser.add_argument('-Q', "--quiet", help='disable default output', action="store_true" )
-
-    return parser.parse_args()
+    parser.add_argument("--profile", metavar="DIR", help='write per-phase cProfile and tracemalloc data to DIR')
+    parser.add_argument("--changed-files", metavar="FILE",
+            help='build only targets affected by the files listed in FILE ("-": stdin)')
+    parser.add_argument("--shard", metavar="I/N", type=parse_shard,
+            help='build only the I-th of N parts (of about equal cost) of the wanted targets')
+    parser.add_argument("--shard-durations", metavar="FILE",
+            help='use target durations from FILE (a .pyjam/durations shared by all shards) as --shard costs')
+    parser.add_argument("--progress", metavar="SECONDS", type=float, nargs="?", const=0,
+            help='periodically print progress and ETA (default interval: 2s on a terminal, 10s otherwise)')
+
+    return parser.parse_args(argv)
 
 def subinclude(dirname):
     return include(os.path.join(dirname, 'build.py'))
@@ -869,6 +1658,8 @@ def include(filename):
         return
 
     _included_set.add(fullpath)
+    if _include_stack:
+        _included_by.setdefault(fullpath, set()).add(_include_stack[-1])
     _include_stack.append(fullpath)
     _cwd_stack.append(os.getcwd())
     dirname = os.path.dirname(fullpath)
@@ -884,9 +1675,8 @@ def include(filename):
             stat = os.stat(fullpath)
             if stat:
                 _newest_buildfile = max(stat.st_mtime, _newest_buildfile)
-            with open(fullpath) as f:
-                code = compile(f.read(), fullpath, 'exec')
-                _include_cache[fullpath] = code
+            code = load_code(fullpath, stat)
+            _include_cache[fullpath] = code
 
         saved_globals = globals().copy()
         globals()['_relpath'] = os.path.relpath(dirname, _basedir)
@@ -914,6 +1704,33 @@ def include(filename):
     _relpath = os.path.relpath(last_cwd, _basedir)
     _include_stack.pop()
 
+def load_code(fullpath, stat):
+    # like __pycache__, keep compiled buildfiles on disk, keyed by
+    # interpreter, path, mtime and size
+    key = (importlib.util.MAGIC_NUMBER, fullpath, stat.st_mtime_ns, stat.st_size)
+    cache_file = state_file(os.path.join("bytecode", hashlib.sha1(fullpath.encode()).hexdigest()))
+    try:
+        with open(cache_file, "rb") as f:
+            if marshal.load(f) == key:
+                dprint("include", "Using cached bytecode for \"%s\"." % fullpath)
+                return marshal.load(f)
+    except (OSError, EOFError, ValueError, TypeError):
+        pass
+
+    with open(fullpath) as f:
+        code = compile(f.read(), fullpath, 'exec')
+
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        with open(cache_file + ".tmp", "wb") as f:
+            marshal.dump(key, f)
+            marshal.dump(code, f)
+        os.replace(cache_file + ".tmp", cache_file)
+    except OSError as e:
+        dprint("warning", "warning: cannot write bytecode cache %s (%s)" % (cache_file, e))
+
+    return code
+
 def export(variables):
     _export("Locally", _var_exports, variables)
 
@@ -954,11 +1771,74 @@ def shell(commands, env=None):
     if not env:
         env = _env()
 
-    handle = _cmd_server_pool.runcmd(_shell_options + [commands], env=env, shell=True)
+    if _exit_threads:
+        return 1
+
+    argv = split_command(commands, env)
+    if argv:
+        dprint("commands", "+", " ".join(argv))
+        handle = _cmd_server_pool.runcmd(argv, env=env)
+    else:
+        handle = _cmd_server_pool.runcmd(_shell_options + [commands], env=env, shell=True)
+    if _exit_threads:
+        # cancel_build() might have run while the command was starting
+        _cmd_server_pool.kill_all()
     output, result = handle.wait()
+    if result < 0 and _exit_threads:
+        # killed by cancel_build()
+        return result
     print(output, end="")
     return result
 
+def split_command(command, env):
+    # Returns the argv for running command directly, or None if it needs a
+    # shell.
+    argv = split_words(command, env)
+
+    if not argv or "=" in argv[0] or argv[0] in _shell_builtins:
+        return None
+
+    return argv
+
+def split_words(command, env):
+    # Returns the words sh would pass for command, or None if it contains
+    # anything but single quotes and $VAR / ${VAR} (expanded from env and
+    # word-split, like sh does).
+    argv = []
+    word = None
+    for match in _command_token.finditer(command):
+        space, quoted, var, var2, plain, other = match.groups()
+        if space:
+            if word is not None:
+                argv.append(word)
+                word = None
+        elif quoted is not None:
+            word = (word or "") + quoted
+        elif var or var2:
+            value = env.get(var or var2, "")
+            if "*" in value or "?" in value or "[" in value:
+                return None
+            if value[:1].isspace() and word is not None:
+                argv.append(word)
+                word = None
+            for n, field in enumerate(value.split()):
+                if n:
+                    argv.append(word)
+                    word = None
+                word = (word or "") + field
+            if value[-1:].isspace() and word is not None:
+                argv.append(word)
+                word = None
+        elif plain and _shell_chars.isdisjoint(plain):
+            word = (word or "") + plain
+        else:
+            return None
+
+    if word is not None:
+        argv.append(word)
+
+    return argv
+
 def globalize(fields):
     fields = listify(fields)
 
@@ -1007,21 +1887,16 @@ def locate_bin(targets, context=None):
     context = context or ctx
     result = []
     bindir = context.get('bindir') or relbase(os.path.join(_basedir, "bin"))
+    # paths below the context's srcdir (if set) are located relative to it
+    srcdir = context.get('srcdir')
 
-    mkdir(bindir)
-
+    # output directories are created when a target actually gets built,
+    # see Target.output_dirs()
     for target in listify(targets):
+        if srcdir and target.startswith(srcdir + os.sep):
+            target = target[len(srcdir)+1:]
         bin_path = os.path.join(bindir, target)
         result.append(bin_path)
-        try:
-            dirname = os.path.join(_basedir, os.path.dirname(bin_path))
-            if dirname:
-                #print(dirname, bindir)
-                mkdir(dirname, bindir)
-        except FileExistsError:
-            pass
-        except FileNotFoundError as e:
-            print(e)
 
         dprint("locate", "Locating target \"%s\" to \"%s\". (relpath=%s)" % (target, bin_path, _relpath))
 
@@ -1065,6 +1940,14 @@ def check_depends():
 
 def clean_exit(code=0):
     os.chdir(_start_cwd)
+    if _basedir:
+        save_dir_cache()
+        if _output_hashes_dirty:
+            save_state("hashes", dict(_output_hashes))
+        if _durations_dirty:
+            save_state("durations", dict(_durations))
+        if _failed_dirty:
+            save_state("failed", set(_failed))
     if _cmd_server_pool:
         _cmd_server_pool.destroy()
     sys.exit(code)
@@ -1074,24 +1957,66 @@ def _err(*args):
     clean_exit(1)
 
 def start_building(all=False):
+    global _progress
+
+    manifest = load_state("manifest")
     if _clean:
         do_clean()
     if _clean_leftovers:
-        do_clean_leftovers()
+        do_clean_leftovers(manifest)
+    update_manifest(manifest)
+
+    Context.freeze()
+    _output_hashes.update(load_state("hashes", {}))
+    _durations.update(load_state("durations", {}))
+    _failed.update(load_state("failed", set()))
+
+    profile_enter("hooks")
+    for hook in _post_parse:
+        hook()
+    profile_leave()
 
     a = time.time()
+    profile_enter("binding")
     bind_targets()
+    profile_leave()
     b = time.time()
+    if args.changed_files:
+        want_changed(args.changed_files)
+    if args.shard:
+        durations = None
+        if args.shard_durations:
+            try:
+                with open(os.path.join(_start_cwd, args.shard_durations), "rb") as f:
+                    durations = pickle.load(f)
+            except Exception as e:
+                _err("cannot read %s (%s)" % (args.shard_durations, e))
+        shard_wanted(args.shard[0], args.shard[1], durations)
+
+    profile_enter("select_wanted")
     select_wanted(all)
+    profile_leave()
     c = time.time()
+    if args.progress is not None:
+        interval = args.progress or (2 if sys.stdout.isatty() else 10)
+        _progress = Progress(args.jobs or 1, interval)
+        _progress.start(_wanted)
+
+    profile_enter("scheduling")
     build_targets(all)
+    profile_leave()
     d = time.time()
 
     dprint("times", "... times: binding: %.3f select_wanted: %.3fs building: %.3fs" %
             (b-a, c-b, d-c))
 
 if __name__ == '__main__':
-    args = parse_args()
+    query_args = None
+    if sys.argv[1:2] == ["query"]:
+        query_args = query.parse_args(sys.argv[2:])
+        args = parse_args(["-Q"])
+    else:
+        args = parse_args()
 
     if args.quiet:
         _debug_levels.discard("default")
@@ -1125,9 +2050,10 @@ if __name__ == '__main__':
 
     # instantiate cmdserver subprocess
     _cmd_server_pool = cmdserver.CmdServerPool(args.jobs or 1)
+    signal.signal(signal.SIGINT, interrupted)
 
     globalize(["_prio", "_unbound_targets", "_build_queue", "_targets", "_post_parse", "_post_bind", "_pre_build",
-        "_created_files", "_clean_leftovers"])
+        "_created_files", "_clean_leftovers", "_dir_cache", "_dir_cache_dirty"])
 
     # filter VAR=val from targets
     filter_vars(args.targets)
@@ -1135,10 +2061,22 @@ if __name__ == '__main__':
     #
     want_targets(args.targets)
 
+    if query_args:
+        clean_exit(run_query(query_args))
+
+    # without targets, clean doesn't need the buildfiles
+    if _clean and not args.targets:
+        set_basedir()
+        if clean_from_manifest():
+            clean_exit(0)
+
     # start subthreads
     start_workers()
 
-    dprint("phases", "... entering parsing phase ...")
+    if args.profile:
+        _profiler = PhaseProfiler(abspath(args.profile))
+
+    profile_enter("parsing")
     before = time.time()
     try:
         # set basedir to project root
@@ -1155,21 +2093,32 @@ if __name__ == '__main__':
         traceback.print_exc()
         clean_exit(1)
 
+    profile_leave()
     after = time.time()
     dprint("times", "... parsing took %.3fs" % (after - before))
 
     start_building(True)
 
+    profile_enter("building")
     before = time.time()
-    if not args.jobs:
-        worker(_build_queue)
+    try:
+        if not args.jobs:
+            worker(_build_queue)
 
-    _build_queue.join()
+        _build_queue.join()
+    except KeyboardInterrupt:
+        # see interrupted(), running commands have been killed already
+        clean_exit(130)
     after = time.time()
+    profile_leave()
+    if _progress:
+        _progress.stop.set()
     dprint("times", "... building took %.3fs" % (after - before))
 
     for target, missing in _skipped:
         dprint("default", "... skipped %s for lack of %s..." % (target, missing))
 
     dprint("default", "... updated", Target._updated, "target(s) ...")
-    clean_exit(0)
+    if _profiler:
+        _profiler.finish()
+    clean_exit(1 if _build_failed or _skipped or _exit_threads else 0)
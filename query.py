@@ -0,0 +1,242 @@
+#
+# query.py
+#
+# Queries on pyjam's dependency graph, e.g., "what depends on this header",
+# "how does this binary end up depending on that file" or "why would this
+# target be rebuilt". Used by "pyjam query", but GraphIndex can be used from
+# python as well (pyjam's graph_index() creates one for the parsed graph).
+#
+# The index only contains plain data (names), so it can be pickled and
+# queries don't need the buildfiles to be parsed again.
+#
+
+import argparse
+import os
+from collections import deque
+
+class GraphIndex(object):
+    def __init__(s, deps, generated=(), virtual=(), modules=None, binaries=None):
+        # deps:      target name -> names of its dependencies
+        # generated: names of targets pyjam knows how to build
+        # virtual:   names of targets that are no files
+        # modules:   module name -> (used modules, needed modules, used?)
+        # binaries:  target name -> names of the modules linked into it
+        s._deps = deps
+        s.generated = set(generated)
+        s.virtual = set(virtual)
+        s.modules = modules or {}
+        s.binaries = binaries or {}
+        s._rdeps = None
+
+    def __contains__(s, name):
+        return name in s._deps
+
+    def deps(s, name, transitive=False):
+        if transitive:
+            return s._reach(name, s._deps)
+        return list(s._deps.get(name, ()))
+
+    def rdeps(s, name, transitive=False):
+        if s._rdeps is None:
+            s._rdeps = {}
+            for target, deps in s._deps.items():
+                for dep in deps:
+                    s._rdeps.setdefault(dep, []).append(target)
+        if transitive:
+            return s._reach(name, s._rdeps)
+        return list(s._rdeps.get(name, ()))
+
+    def _reach(s, name, edges):
+        res = []
+        seen = { name }
+        stack = [ name ]
+        while stack:
+            for other in edges.get(stack.pop(), ()):
+                if not other in seen:
+                    seen.add(other)
+                    res.append(other)
+                    stack.append(other)
+        return res
+
+    def somepath(s, start, end, edges=None):
+        # a shortest dependency chain from start to end, or None
+        edges = edges or s._deps
+        parents = { start : None }
+        queue = deque([ start ])
+        while queue:
+            name = queue.popleft()
+            if name == end:
+                path = []
+                while name is not None:
+                    path.append(name)
+                    name = parents[name]
+                return path[::-1]
+            for other in edges.get(name, ()):
+                if not other in parents:
+                    parents[other] = name
+                    queue.append(other)
+        return None
+
+    def allpaths(s, start, end):
+        # all dependency edges on any chain from start to end
+        reachable = set(s.deps(start, True))
+        if not end in reachable:
+            return []
+        nodes = (reachable & set(s.rdeps(end, True))) | { start, end }
+        return [ (name, dep) for name in sorted(nodes) for dep in s._deps.get(name, ()) if dep in nodes ]
+
+    def module_edges(s):
+        # used modules -> used modules they use
+        edges = {}
+        for name, (uses, needs, used) in s.modules.items():
+            if used:
+                edges[name] = [ dep for dep in uses if s.modules.get(dep, (0, 0, False))[2] ]
+        return edges
+
+    def module_users(s, module, transitive=False):
+        users = {}
+        for name, deps in s.module_edges().items():
+            for dep in deps:
+                users.setdefault(dep, []).append(name)
+        if transitive:
+            return s._reach(module, users)
+        return users.get(module, [])
+
+    def why_module(s, binary, module):
+        # the chain of modules pulling module into binary
+        edges = s.module_edges()
+        edges[binary] = s.binaries.get(binary, ())
+        path = s.somepath(binary, module, edges)
+        return path and path[1:]
+
+    def mtime(s, name):
+        try:
+            return os.stat(name).st_mtime
+        except OSError:
+            return None
+
+    def stale(s, name, newest_buildfile=0):
+        # Returns the reasons name would be rebuilt, as chains ending in a
+        # root cause (missing or newer file). Empty if it is up to date.
+        reasons = []
+        causes = {}
+
+        def check(name):
+            if name in causes:
+                return causes[name]
+            causes[name] = None
+            res = None
+            if name in s.virtual:
+                mtime = None
+            else:
+                mtime = s.mtime(name)
+                if mtime is None:
+                    res = [ "%s does not exist" % name ]
+                elif name in s.generated and mtime < newest_buildfile:
+                    res = [ "%s is older than a buildfile" % name ]
+            for dep in s._deps.get(name, ()) if res is None else ():
+                chain = check(dep)
+                if chain:
+                    res = [ "%s depends on %s" % (name, dep) ] + chain
+                    break
+                dep_mtime = None if dep in s.virtual else s.mtime(dep)
+                if mtime is not None and dep_mtime is not None and dep_mtime > mtime:
+                    res = [ "%s is newer than %s" % (dep, name) ]
+                    break
+            causes[name] = res
+            return res
+
+        chain = check(name)
+        if chain:
+            reasons.append(chain)
+        return reasons
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog='pyjam query', description='query the dependency graph')
+    parser.add_argument("--refresh", action="store_true", help='parse buildfiles even if the index is current')
+    sub = parser.add_subparsers(dest="query", metavar="query")
+    sub.required = True
+
+    for name, help in (("deps", "dependencies of TARGET"), ("rdeps", "targets depending on TARGET")):
+        p = sub.add_parser(name, help=help)
+        p.add_argument("target")
+        p.add_argument("-t", "--transitive", action="store_true")
+
+    for name, help in (("somepath", "a dependency chain from FROM to TO"),
+            ("allpaths", "all dependency edges between FROM and TO")):
+        p = sub.add_parser(name, help=help)
+        p.add_argument("start", metavar="FROM")
+        p.add_argument("end", metavar="TO")
+
+    p = sub.add_parser("users", help='modules using MODULE')
+    p.add_argument("module")
+    p.add_argument("-t", "--transitive", action="store_true")
+
+    p = sub.add_parser("why-module", help='what pulls MODULE into BINARY')
+    p.add_argument("binary")
+    p.add_argument("module")
+
+    p = sub.add_parser("stale", help='why TARGET would be rebuilt')
+    p.add_argument("target")
+
+    return parser.parse_args(argv)
+
+def resolve_module(index, name):
+    # full module names (bin/<board>/<module>) or just the module's name
+    if name in index.modules:
+        return [ name ]
+    return sorted(module for module in index.modules if os.path.basename(module) == name)
+
+def run(index, args, locate=lambda name: name, newest_buildfile=0):
+    # runs a query parsed by parse_args(), locate() maps target names
+    # given on the command line to the graph's names
+    if args.query in ("deps", "rdeps"):
+        for name in sorted(getattr(index, args.query)(locate(args.target), args.transitive)):
+            print(name)
+
+    elif args.query == "somepath":
+        path = index.somepath(locate(args.start), locate(args.end))
+        if not path:
+            print("no path from %s to %s" % (args.start, args.end))
+            return 1
+        for name in path:
+            print(name)
+
+    elif args.query == "allpaths":
+        edges = index.allpaths(locate(args.start), locate(args.end))
+        if not edges:
+            print("no path from %s to %s" % (args.start, args.end))
+            return 1
+        for name, dep in edges:
+            print("%s -> %s" % (name, dep))
+
+    elif args.query == "users":
+        for module in resolve_module(index, args.module):
+            print("%s:" % module)
+            for user in sorted(index.module_users(module, args.transitive)):
+                print("  %s" % user)
+
+    elif args.query == "why-module":
+        binary = locate(args.binary)
+        found = False
+        for module in resolve_module(index, args.module):
+            path = index.why_module(binary, module)
+            if path:
+                found = True
+                print(" -> ".join(path))
+        if not found:
+            print("%s does not use %s" % (args.binary, args.module))
+            return 1
+
+    elif args.query == "stale":
+        target = locate(args.target)
+        if not target in index:
+            print("unknown target %s" % args.target)
+            return 1
+        reasons = index.stale(target, newest_buildfile)
+        if not reasons:
+            print("%s is up to date" % target)
+        for chain in reasons:
+            print("\n  because ".join(chain))
+
+    return 0
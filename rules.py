@@ -1,4 +1,7 @@
 import boolparse
+import includescan
+import re
+from collections import deque
 
 #
 builders={}
@@ -44,18 +47,54 @@ class BuildContext(object):
 
     def finalize():
         dprint("verbose", " ... running hooks for build context \"%s\"..." % ctx._name)
+        profile_enter("hooks")
         for prio, hook, args in sorted(ctx._hooks, key=lambda x: x[0]):
             hook(*args)
+        profile_leave()
 
 #       parallel building/parsing not ready
 #        start_building()
 
+def build_matrix(examples, boards, board_setup=None, setup=None, bindir=None):
+    # Creates one BuildContext per example/board combination, all within
+    # this process, so rules.py and buildfiles get compiled only once and
+    # all configurations end up in one graph built by one worker pool.
+    #
+    # board_setup(board) runs once per board in a board context that is
+    # the parent of all of that board's example contexts, so board settings
+    # are evaluated only once. setup(board, example) runs within each
+    # example context before the example's build.py is included.
+    bindir = bindir or relbase(os.path.join(_basedir, "bin"))
+    for board in listify(boards):
+        BuildContext.init(board, bindir=os.path.join(bindir, board))
+        board_context = ctx
+        if board_setup:
+            board_setup(board)
+
+        for example in listify(examples):
+            dprint("verbose", " ... matrix: example \"%s\" for board \"%s\"" % (example, board))
+            # keyed on the path, examples might share their basename
+            name = relbase(os.path.abspath(example))
+            BuildContext.init("%s@%s" % (name, board),
+                    bindir=os.path.join(bindir, board, name),
+                    parent=board_context)
+            # the bindir already names the example, don't repeat it for its sources
+            ctx.srcdir = name
+            Module.init_context()
+            if setup:
+                setup(board, example)
+            subinclude(example)
+            BuildContext.finalize()
+
+        set_context(default)
+
 class Rule(object):
     def __init__(s, targets, sources, **kwargs):
         global ctx
 
         s.targets=listify(targets)
         s.sources=listify(sources)
+        s.buildfile = _include_stack[-1] if _include_stack else None
 
         cname = s.__class__.__name__ + "(" + ", ".join(s.targets) + ")"
         s.context = Context(name=cname, parents=kwargs.get('context', ctx))
@@ -76,7 +115,7 @@ class Rule(object):
 class Main(Rule):
     def __init__(s, targets, sources=None, **kwargs):
         if not sources:
-            sources = glob.glob("*.c") + glob.glob("*.S")
+            sources = glob_files(["*.c", "*.S"])
 
         if not sources:
             raise Exception("Main(): no sources given!")
@@ -95,13 +134,23 @@ class Module(Rule):
         ctx._module_map = {}
 
     def is_used(name):
-        module = ctx._module_map.get(locate_bin(name)[0])
+        module = ctx._module_map.get(Module.locate_name(name))
         if module:
             dprint("debug", "USE_IF is_used", module.name, ":", module.used)
             return module.used
         else:
             return False
 
+    def locate_name(name):
+        # use_if() conditions name modules relative to the context's bindir
+        if ctx._module_names is None:
+            ctx._module_names = {}
+        path = ctx._module_names.get(name)
+        if not path:
+            path = locate_bin(name)[0]
+            ctx._module_names[name] = path
+        return path
+
     bool_parser = boolparse.BoolParser(is_used)
 
     def __init__(s, targets=None, sources=None, **kwargs):
@@ -109,7 +158,7 @@ class Module(Rule):
             targets = os.path.basename(os.getcwd())
 
         if not sources and not kwargs.get("pseudomodule"):
-            sources = glob.glob("*.c") + glob.glob("*.S")
+            sources = glob_files(["*.c", "*.S"])
 
         if not sources and not kwargs.get("pseudomodule"):
             raise Exception("Module(): no sources given!")
@@ -124,12 +173,18 @@ class Module(Rule):
         s.used = False
 
         kwargs.pop("context", None)
+        if kwargs.get("unity"):
+            s.context.unity = kwargs["unity"]
+        if kwargs.get("unity_exclude"):
+            s.context.unity_exclude += listify(kwargs["unity_exclude"])
+        s._units = 0
         s.add_sources(s.sources)
 
         if s.name in ctx._module_map:
             dprint("warning", "Warning: redefining module %s!" % s.name)
 
         ctx._module_map[s.name]=s
+        ctx._module_graph = None
 
         s.context.defines += s.get_define()
 
@@ -153,41 +208,29 @@ class Module(Rule):
         return "MODULE_" + os.path.basename(s.name).upper().translate(str.maketrans("-", "_"))
 
     def add_sources(s, sources):
-        s.objects.extend(Compile(listify(sources), context=s.context).targets)
+        unity_name = "%s_unity%s" % (os.path.basename(s.name), s._units or "")
+        s._units += 1
+        unity = s.context.unity.combined()
+        s.objects.extend(Compile(listify(sources), context=s.context, unity=unity and unity[-1],
+            unity_exclude=s.context.unity_exclude.combined(), unity_name=unity_name).targets)
         return s
 
-    def get_objects(s, visited=None, unique=False):
-        visited = visited or set()
-        res = []
-        if s in visited:
-            return res
-        visited.add(s)
-
-        res.extend(s.objects)
-        for module in s._uses:
-            module = ctx._module_map.get(module)
-            if module and module.used:
-                res.extend(module.get_objects(visited, False))
+    def graph():
+        if not ctx._module_graph:
+            ctx._module_graph = ModuleGraph(ctx._module_map)
+        return ctx._module_graph
 
+    def get_objects(s, unique=False):
+        res = Module.graph().objects(s)
         if unique:
             return uniquify(res)
         else:
             return res
 
-    def iterate_modules(s, visited=None):
-        visited = visited or set()
-        if s in visited:
-            return
-        visited.add(s)
-
-        if s.used:
-            yield s
-
-        for module in s._uses:
-            module = ctx._module_map.get(module)
-            if module and module.used:
-                for dep in module.iterate_modules(visited):
-                    yield dep
+    def iterate_modules(s):
+        for module in Module.graph().modules(s):
+            if module.used:
+                yield module
 
     def needs(s, modules, hard=True, locate=True):
         if locate:
@@ -195,6 +238,7 @@ class Module(Rule):
         else:
             modules = str_list(listify(modules))
 
+        ctx._module_graph = None
         for module in modules:
             if not module in s._uses:
                 s._uses.append(module)
@@ -219,30 +263,31 @@ class Module(Rule):
         return s
 
     def process_use_if_list():
-        has_changed = True
-        while has_changed:
-            new_list = []
-            has_changed = False
-            for module, condition in ctx._use_if_list:
-                if module.used:
-                    continue
-                if module._process_use_if_hook(condition):
-                    has_changed = True
-                else:
-                    new_list.append((module, condition))
-            if has_changed:
-                ctx._use_if_list = new_list
-
-    def _process_use_if_hook(s, string):
+        # parse every condition once and index it by the modules it mentions,
+        # so when a module gets used, only the conditions depending on it
+        # need to be evaluated again
+        queue = deque()
+        ctx._use_if_index = {}
+        for module, string in ctx._use_if_list:
+            condition = Module.bool_parser.parse(string)
+            entry = (module, condition)
+            for label in set(condition.labels()):
+                ctx._use_if_index.setdefault(Module.locate_name(label), []).append(entry)
+            queue.append(entry)
+
+        ctx._use_if_queue = queue
+        while queue:
+            module, condition = queue.popleft()
+            module._process_use_if_hook(condition)
+
+        ctx._use_if_index = None
+        ctx._use_if_queue = None
+
+    def _process_use_if_hook(s, condition):
         if not s.used:
-            dprint("debug", "USE_IF processing", s.name, string)
-
-            # need to pass context to boolparse / is_used() so
-            # is_used() can use locat_bin() on the module name
-            # (the hook is being executed after possible ctx change)
+            dprint("debug", "USE_IF processing", s.name, condition)
 
-            res = Module.bool_parser.parseString(string)[0]
-            if bool(res):
+            if bool(condition):
                 s._use()
                 return True
             else:
@@ -255,6 +300,10 @@ class Module(Rule):
         dprint("debug", "_USE", s.name)
 
         s.used = True
+        ctx._module_graph = None
+
+        if ctx._use_if_index:
+            ctx._use_if_queue.extend(ctx._use_if_index.get(s.name, ()))
 
         for module_name in s._uses:
             module = ctx._module_map.get(module_name)
@@ -279,7 +328,7 @@ class Module(Rule):
                     if dep:
                         if dep.used:
                             dprint("debug", "+CTX", module.name, dep.name)
-                            module.context._parents.append(dep.context)
+                            module.context.add_parent(dep.context)
                         else:
                             dprint("debug", "-CTX", module.name, dep.name)
 
@@ -309,10 +358,122 @@ class Module(Rule):
 
             print("}", file=f)
 
+class ModuleGraph(object):
+    # Transitive closures of a context's modules over their used
+    # dependencies, computed once as bitsets over module IDs (the position
+    # in the module map). Strongly connected components (modules using each
+    # other) share one closure.
+    def __init__(s, module_map):
+        s._modules = list(module_map.values())
+        s._ids = { module: i for i, module in enumerate(s._modules) }
+        s._objects = {}
+
+        edges = []
+        for module in s._modules:
+            deps = []
+            for name in module._uses:
+                dep = module_map.get(name)
+                if dep and dep.used:
+                    deps.append(s._ids[dep])
+            edges.append(deps)
+
+        s._closures = ModuleGraph._compute_closures(edges)
+
+    def _compute_closures(edges):
+        # iterative Tarjan, SCCs get finished after all SCCs they reach
+        n = len(edges)
+        index = [None] * n
+        low = [0] * n
+        on_stack = [False] * n
+        stack = []
+        closures = [0] * n
+        counter = 0
+
+        for root in range(n):
+            if index[root] is not None:
+                continue
+
+            work = [(root, 0)]
+            while work:
+                v, i = work.pop()
+                if i == 0:
+                    index[v] = low[v] = counter
+                    counter += 1
+                    stack.append(v)
+                    on_stack[v] = True
+
+                recurse = False
+                for j in range(i, len(edges[v])):
+                    w = edges[v][j]
+                    if index[w] is None:
+                        work.append((v, j+1))
+                        work.append((w, 0))
+                        recurse = True
+                        break
+                    elif on_stack[w]:
+                        low[v] = min(low[v], index[w])
+                if recurse:
+                    continue
+
+                if low[v] == index[v]:
+                    members = []
+                    bits = 0
+                    while True:
+                        w = stack.pop()
+                        on_stack[w] = False
+                        members.append(w)
+                        bits |= 1 << w
+                        if w == v:
+                            break
+                    for w in members:
+                        for dep in edges[w]:
+                            bits |= closures[dep]
+                    for w in members:
+                        closures[w] = bits
+
+                if work:
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent], low[v])
+
+        return closures
+
+    def _closure(s, module):
+        i = s._ids.get(module)
+        if i is not None:
+            return s._closures[i]
+
+        # not in the module map (e.g., redefined)
+        bits = 0
+        for name in module._uses:
+            dep = ctx._module_map.get(name)
+            if dep and dep.used:
+                bits |= s._closures[s._ids[dep]]
+        return bits
+
+    def modules(s, module):
+        # module first, then all modules it (transitively) uses in ID order
+        yield module
+        bits = s._closure(module)
+        while bits:
+            low = bits & -bits
+            dep = s._modules[low.bit_length() - 1]
+            if dep is not module:
+                yield dep
+            bits ^= low
+
+    def objects(s, module):
+        res = s._objects.get(module)
+        if res is None:
+            res = []
+            for dep in s.modules(module):
+                res.extend(dep.objects)
+            s._objects[module] = res
+        return list(res)
+
 class ModuleDir(Module):
     def __init__(s, name, dir=None):
         dir = dir or name
-        sources = glob.glob(os.path.join(dir, "*.c")) + glob.glob(os.path.join(dir, "*.S"))
+        sources = glob_files(["*.c", "*.S"], dir)
         super().__init__(name, sources)
 
 class ModuleList(Rule):
@@ -338,8 +499,29 @@ class PseudoModule(Module):
 
 class Compile(Rule):
     def __init__(s, sources, **kwargs):
+        # unity build: compile (up to) "unity" C sources at a time, through
+        # generated files #including them
+        unity = int(kwargs.pop("unity", None) or 0)
+        unity_exclude = listify(kwargs.pop("unity_exclude", None))
+        unity_name = kwargs.pop("unity_name", "unity")
+
         super().__init__([], sources, **kwargs)
-        for source in s.sources:
+
+        sources = s.sources
+        if unity > 1:
+            grouped = sorted(source for source in sources
+                    if source.endswith(".c") and not Compile._excluded(source, unity_exclude))
+            sources = [ source for source in sources if not source in grouped ]
+            for i in range(0, len(grouped), unity):
+                chunk = grouped[i:i+unity]
+                if len(chunk) == 1:
+                    sources.extend(chunk)
+                    continue
+                unit = locate_bin(os.path.join(os.path.dirname(chunk[0]), "%s_%i.c" % (unity_name, i // unity)))
+                UnityFile(unit, chunk, **kwargs)
+                s.targets.extend(UnityCompileC(unit, **kwargs).targets)
+
+        for source in sources:
             n, ext = os.path.splitext(source)
 
             try:
@@ -349,11 +531,22 @@ class Compile(Rule):
             except KeyError:
                 dprint("default", "Don't know how to build %s!" % source)
 
+    def _excluded(source, patterns):
+        for pattern in patterns:
+            if fnmatch.fnmatch(source, pattern) or fnmatch.fnmatch(os.path.basename(source), pattern):
+                return True
+        return False
+
 class Tool(Rule):
     name="TOOL"
     actions="echo unconfigured Tool class: target=%target, sources=%sources"
     clean=True
     depends_on_sources=True
+    dedup=False
+    # if set, %sources / %args longer than this go to a response file (@file)
+    response_file_threshold=None
+    # if set, called as builtin(tool, target, env) instead of running actions
+    builtin=None
     message="[%name] %target %sources"
 
     def __init__(s, target, sources=None, **kwargs):
@@ -363,30 +556,164 @@ class Tool(Rule):
             depends(s.targets, s.sources)
         if s.clean:
             clean(s.targets)
+            if s.response_file_threshold is not None:
+                clean([ "%s.%s.rsp" % (t, kind) for t in s.targets for kind in ("sources", "args") ])
 
     def build(s, target):
         dprint("context", "building", target.name, "with context", target.context)
 
+        my_env = _env(target.context)
+
         sources = " ".join(s.sources)
-        output = s.message.replace("%name", s.name).replace("%target", target.name).replace("%sources", "from " + sources)
+        extra_args = " ".join(s.extra_args(target))
+        command = s.actions.replace("%sources", s.response_file(target, "sources", sources, my_env))
+        command = command.replace("%args", s.response_file(target, "args", extra_args, my_env))
+
+        shared = None
+        if s.dedup:
+            # identical command, environment and inputs produce identical
+            # outputs, so only build them once and link them everywhere else
+            key = (command, tuple(sorted(my_env.items())), tuple(str(dep) for dep in target.deps))
+            shared, first = claim_action(key, target)
+            if not first:
+                if not shared.wait():
+                    return False
+                if s.reuse(shared, target):
+                    return True
+                # the shared outputs are gone, build them here
+                shared = None
+
+        result = False
+        try:
+            # everything after claiming must be within try, others might
+            # be waiting for shared.finish()
+            if s.dedup:
+                for output in s.outputs(target):
+                    unlink_shared(output)
 
-        dprint("default", output)
+            output = s.message.replace("%name", s.name).replace("%target", target.name).replace("%sources", "from " + sources)
 
-        extra_args = " ".join(s.extra_args(target))
-        actions = s.actions.replace("%target", target.name).replace("%sources", sources).replace("%args", extra_args)
+            dprint("default", output)
 
-        my_env = _env(target.context)
+            actions = command.replace("%target", target.name)
+
+            if s.builtin:
+                result = s.run_builtin(target, my_env)
+            else:
+                result = shell(actions, env=my_env)==0
+            if not result and build_cancelled():
+                # don't leave partial outputs of killed commands behind
+                for output in s.outputs(target):
+                    try:
+                        os.unlink(output)
+                    except FileNotFoundError:
+                        pass
+        finally:
+            if shared:
+                shared.finish(result)
+
+        return result
+
+    def reuse(s, shared, target):
+        # links the outputs of the finished shared action, False if the
+        # primary output couldn't be linked
+        dprint("verbose", "... reusing %s for %s" % (shared.target.name, target.name))
+        for i, (src, dst) in enumerate(zip(s.outputs(shared.target), s.outputs(target))):
+            if not link_file(src, dst) and i == 0:
+                dprint("verbose", "... cannot reuse %s for %s" % (shared.target.name, target.name))
+                return False
 
-        return shell(actions, env=my_env)==0
+        return True
+
+    def outputs(s, target):
+        return [target.name]
 
     def extra_args(s, target):
         return []
 
+    def run_builtin(s, target, env):
+        if build_cancelled():
+            return False
+        dprint("commands", "+ (builtin) %s %s" % (s.builtin.__name__, target.name))
+        try:
+            return s.builtin(target, env) != False
+        except OSError as e:
+            dprint("error", "%s: %s" % (target.name, e))
+            return False
+
+    def response_file(s, target, kind, joined, env):
+        if s.response_file_threshold is None or len(joined) <= s.response_file_threshold:
+            return joined
+
+        # the response file gets the words as sh would pass them, e.g.
+        # without the quotes added by Var.prefix()
+        words = split_words(joined, env)
+        if words is None:
+            dprint("verbose", "... %s: %%%s needs a shell, not using a response file" % (target.name, kind))
+            return joined
+
+        path = "%s.%s.rsp" % (target.name, kind)
+        content = "".join(Tool._rsp_quote(word) + "\n" for word in words)
+
+        # only rewrite if changed, keeping the mtime otherwise
+        try:
+            with open(path) as f:
+                if f.read() == content:
+                    return "@" + path
+        except OSError:
+            pass
+
+        dprint("verbose", "... writing response file", path)
+        with open(path + ".tmp", "w") as f:
+            f.write(content)
+        os.replace(path + ".tmp", path)
+
+        return "@" + path
+
+    def _rsp_quote(arg):
+        # gcc / binutils style: whitespace separates, backslash escapes
+        return re.sub(r'([\s\\\'"])', r'\\\1', arg)
+
+# builtin actions, see Tool.builtin
+
+def builtin_true(tool, target, env):
+    return True
+
+def builtin_touch(tool, target, env):
+    touch(target.name)
+
+def builtin_copy(tool, target, env):
+    shutil.copy2(tool.sources[0], target.name)
+
+def builtin_mkdir(tool, target, env):
+    os.makedirs(target.name, exist_ok=True)
+
+def builtin_write(tool, target, env):
+    # writes tool.content(target), only if changed (keeping the mtime)
+    content = tool.content(target.name)
+    try:
+        with open(target.name) as f:
+            if f.read() == content:
+                return
+    except OSError:
+        pass
+
+    with open(target.name + ".tmp", "w") as f:
+        f.write(content)
+    os.replace(target.name + ".tmp", target.name)
+
+def builtin_write_env(tool, target, env):
+    with open(target.name, "w") as f:
+        for name, value in sorted(env.items()):
+            f.write("%s=%s\n" % (name, value))
+
 class ObjectCompiler(Tool):
+    dedup=True
+
     def __init__(s, sources, **kwargs):
         sources = listify(sources)
         for source in sources:
-            obj=locate_bin(subst_ext(source, '.o'))
+            obj=s.object_path(source)
 
             super().__init__(obj, source, **kwargs)
 
@@ -397,6 +724,9 @@ class ObjectCompiler(Tool):
             except AttributeError:
                 pass
 
+    def object_path(s, source):
+        return locate_bin(subst_ext(source, '.o'))
+
     def extra_args(s, target):
         includes = target.context.includes
 
@@ -406,13 +736,21 @@ class CompileCcommon(ObjectCompiler):
     actions="${CCACHE} ${CC} ${CFLAGS} %args -c %sources -o %target"
     name='CC'
 
+    # if enabled, sources without .d file get scanned for #include's
+    scan_includes=False
+    # if enabled, the context's precompiled headers (see PrecompiledHeader) are used
+    use_pch=False
+    _pch=None
+    _scanner = includescan.IncludeScanner(lambda path: os.path.isfile(path) or path in _non_source_targets)
+    _unscanned = {}
+
     def parse_gcc_deps(filename):
         try:
             alldeps = ""
             for line in open(filename):
                 alldeps += line.rstrip().rstrip("\\")
 
-            return " ".join(alldeps.split()).split()[2:]
+            return [ os.path.normpath(dep) for dep in alldeps.split()[2:] ]
 
         except FileNotFoundError:
             pass
@@ -420,20 +758,154 @@ class CompileCcommon(ObjectCompiler):
     def parse_deps(s, source, obj):
         depfile = os.path.join(_basedir, subst_ext(obj, '.d'))
         clean(relbase(depfile))
-        return CompileCcommon.parse_gcc_deps(depfile)
+        deps = CompileCcommon.parse_gcc_deps(depfile)
+        if deps is None and s.scan_includes:
+            CompileCcommon._unscanned[obj] = source
+        if s.use_pch:
+            # only the headers precompiled so far get built first, so only
+            # those may be used
+            if s._pch is None:
+                s._pch = {}
+            s._pch[obj] = s.context.pch.combined()
+            deps = (deps or []) + [ stub + ".gch" for stub in s._pch[obj] ]
+        return deps
+
+    def scan_unscanned():
+        # runs after parsing, when all contexts (and thus include paths)
+        # are final. Only objects that are actually wanted get scanned.
+        if not CompileCcommon._unscanned:
+            return
+
+        scanned = 0
+        for target in list(reachable_targets(_wanted_names)):
+            source = CompileCcommon._unscanned.get(target.name)
+            if not source:
+                continue
+            includes = target.context.includes.combined()
+            for header in CompileCcommon._scanner.scan(source, includes):
+                depends(target.name, header)
+            scanned += 1
+
+        dprint("verbose", "... scanned %i sources for includes" % scanned)
+        CompileCcommon._unscanned = {}
 
     def extra_args(s, target):
         defines = target.context.defines
-        return super().extra_args(target) + ["-MMD"] + defines.prefix("-D")
+        res = super().extra_args(target) + ["-MMD"] + defines.prefix("-D")
+        if s.use_pch:
+            for stub in s._pch.get(target.name, ()):
+                res += [ "-include", stub, "-Winvalid-pch" ]
+        return res
+
+    def outputs(s, target):
+        return super().outputs(target) + [subst_ext(target.name, '.d')]
+
+_post_parse.append(CompileCcommon.scan_unscanned)
 
 class CompileC(CompileCcommon):
     actions="${CCACHE} ${CC} ${CFLAGS} %args -c %sources -o %target"
     name='CC'
+    use_pch=True
 
 class CompileCpp(CompileCcommon):
     actions="${CCACHE} ${CXX} ${CXXFLAGS} %args -c %sources -o %target"
     name='C++'
 
+class UnityFile(Tool):
+    name="UNITY"
+    message="[%name] %target"
+    depends_on_sources=False
+    builtin=builtin_write
+
+    def __init__(s, target, sources, **kwargs):
+        super().__init__(target, sources, **kwargs)
+
+        # Only the list of sources matters (their contents are tracked
+        # through the object's .d file). If it changed (e.g., a new globbed
+        # file), remove the outdated unit so it gets regenerated. Targets
+        # are relative to the project root, the cwd is the buildfile's dir.
+        for target in s.targets:
+            path = os.path.join(_basedir, target)
+            try:
+                with open(path) as f:
+                    if f.read() != s.content(target):
+                        os.unlink(path)
+            except OSError:
+                pass
+
+    def content(s, target):
+        dir = os.path.dirname(target)
+        return "".join('#include "%s"\n' % os.path.relpath(source, dir) for source in s.sources)
+
+class UnityCompileC(CompileC):
+    def object_path(s, source):
+        # source is a generated unit, already in bindir
+        return [ subst_ext(source, '.o') ]
+
+class PrecompiledHeaderStub(UnityFile):
+    name="PCH"
+
+class PrecompiledHeader(CompileCcommon):
+    # Precompiles header for the current context. All C sources compiled
+    # in it (or its children) afterwards get it through "-include".
+    #
+    # The header is wrapped in a generated stub in the bindir, which is
+    # what gets precompiled (to <stub>.gch). If gcc rejects the .gch, it
+    # falls back to the stub, which includes the real header.
+    actions="${CCACHE} ${CC} ${CFLAGS} %args -x c-header -c %sources -o %target"
+    name='PCH'
+    _all = []
+
+    def __init__(s, header, **kwargs):
+        context = kwargs.get('context') or ctx
+        header = relpath(header)
+        stub = locate_bin(header)[0]
+        PrecompiledHeaderStub(stub, header, **kwargs)
+        super().__init__(stub, **kwargs)
+        clean(stub + ".gch.cmd")
+        context.pch += stub
+        PrecompiledHeader._all.append(s)
+
+    def object_path(s, source):
+        return [ source + ".gch" ]
+
+    def signature(s, target):
+        # the command line, with flags, defines and includes as they are now
+        command = s.actions.replace("%sources", " ".join(s.sources))
+        command = command.replace("%args", " ".join(s.extra_args(target)))
+        command = command.replace("%target", target.name)
+        env = _env(target.context)
+        argv = split_command(command, env)
+        if argv:
+            return " ".join(argv)
+        return "\n".join([command] + [ "%s=%s" % item for item in sorted(env.items()) ])
+
+    def build(s, target):
+        result = super().build(target)
+        if result:
+            with open(target.name + ".cmd", "w") as f:
+                f.write(s.signature(target))
+        return result
+
+    def check_signatures():
+        # Changes of e.g. CFLAGS on the command line don't touch any file,
+        # so compare the command line a .gch was built with and remove it if
+        # it changed.
+        for pch in PrecompiledHeader._all:
+            for name in pch.targets:
+                try:
+                    with open(name + ".cmd") as f:
+                        if f.read() == pch.signature(_targets[name]):
+                            continue
+                    dprint('cause', "%s was built with different flags, rebuilding." % name)
+                    os.unlink(name)
+                except OSError:
+                    pass
+
+        PrecompiledHeader._all = []
+
+_post_parse.append(PrecompiledHeader.check_signatures)
+
 class CompileAsm(ObjectCompiler):
     actions="${AS} ${ASFLAGS} %args -c %sources -o %target"
     name='AS'
@@ -469,6 +941,7 @@ builders['.S'] = CompileAsm
 
 class Link(Tool):
     name="LINK"
+    response_file_threshold=32768
     actions="${LINK} ${LINKFLAGS} -Wl,--start-group %sources %args -Wl,--end-group -o %target"
 
     def extra_args(s, target):
@@ -476,6 +949,7 @@ class Link(Tool):
 
 class LinkModule(Tool):
     name="LINK"
+    response_file_threshold=32768
     actions="${LINK} -Wl,--start-group %sources -Wl,--end-group %args ${LINKFLAGS} -o %target"
     message="[%name] %target"
 
@@ -495,8 +969,7 @@ class LinkModule(Tool):
                 continue
 
             objects.extend(module.get_objects())
-            if not module.context in s.context._parents:
-                s.context._parents.append(module.context)
+            s.context.add_parent(module.context)
 
         s.sources = objects
         depends(s.targets, s.sources)
@@ -506,6 +979,7 @@ class LinkModule(Tool):
 
 class Archive(Tool):
     name="AR"
+    response_file_threshold=32768
     actions="${AR} rcs %target %sources"
 
 class Toolcheck(Rule):
@@ -531,14 +1005,21 @@ class Print(Rule):
         dprint("default", s.message)
         return True
 
-#class Mkdir(Tool):
-#    name="MKDIR"
-#    actions="mkdir -p -- %target"
-#    clean=False # rm -f on dir is dangerous!
+class Mkdir(Tool):
+    name="MKDIR"
+    actions="mkdir -p -- %target"
+    builtin=builtin_mkdir
+    clean=False # rm -f on dir is dangerous!
 
 class Touch(Tool):
     name="TOUCH"
     actions="touch -- %target"
+    builtin=builtin_touch
+
+class Copy(Tool):
+    name="COPY"
+    actions="cp -p -- %sources %target"
+    builtin=builtin_copy
 
 class NoOp(Tool):
     name="NOOP"
@@ -550,11 +1031,13 @@ class NoOp(Tool):
 class NoOpShell(Tool):
     name="NOOPSHELL"
     actions="true"
+    builtin=builtin_true
 
 class DebugEnv(Tool):
     name="DebugEnv"
     clean=True
     actions = "set > %target"
+    builtin=builtin_write_env
 
 class Fail(Rule):
     def __init__(s, target):
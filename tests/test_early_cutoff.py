@@ -0,0 +1,62 @@
+#
+# Early cutoff: a rebuilt object with unchanged content must not cause its
+# dependents (here a binary and a copy of it) to be rebuilt, neither in the
+# same run nor in the next one.
+#
+# usage: python -m unittest discover tests
+#
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+pyjam = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "pyjam.py")
+
+main_c = '''\
+/* %s */
+int main(void)
+{
+    return 0;
+}
+'''
+
+project_py = '''\
+Main("hello")
+Copy("bin/hello.bin", "bin/hello")
+depends("all", "bin/hello.bin")
+'''
+
+@unittest.skipUnless(shutil.which("gcc"), "needs gcc")
+class EarlyCutoffTest(unittest.TestCase):
+    def setUp(s):
+        s.basedir = tempfile.mkdtemp(prefix="pyjam-test-")
+        s.write("main.c", main_c % "first")
+        s.write("project.py", project_py)
+
+    def tearDown(s):
+        shutil.rmtree(s.basedir)
+
+    def write(s, name, content):
+        with open(os.path.join(s.basedir, name), "w") as f:
+            f.write(content)
+
+    def build(s):
+        output = subprocess.check_output([sys.executable, pyjam], cwd=s.basedir,
+                universal_newlines=True)
+        return [ line.split()[0] for line in output.splitlines() if line.startswith("[") ]
+
+    def test_chain(s):
+        s.assertEqual(s.build(), ["[CC]", "[LINK]", "[COPY]"])
+
+        # the edit has to be newer than the outputs, also with coarse mtimes
+        time.sleep(1)
+        s.write("main.c", main_c % "second")
+        s.assertEqual(s.build(), ["[CC]"])
+        s.assertEqual(s.build(), [])
+
+if __name__ == '__main__':
+    unittest.main()
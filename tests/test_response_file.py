@@ -0,0 +1,57 @@
+#
+# Links a real binary with gcc through response files (see
+# Tool.response_file_threshold).
+#
+# usage: python -m unittest discover tests
+#
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+pyjam = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "pyjam.py")
+
+main_c = '''\
+#include <math.h>
+#include <stdio.h>
+
+int main(void)
+{
+    printf("%.1f\\n", sqrt(16.0));
+    return 0;
+}
+'''
+
+project_py = '''\
+Link.response_file_threshold = 1
+ctx.objects += "-lm"
+Main("hello")
+'''
+
+@unittest.skipUnless(shutil.which("gcc"), "needs gcc")
+class ResponseFileTest(unittest.TestCase):
+    def setUp(s):
+        s.basedir = tempfile.mkdtemp(prefix="pyjam-test-")
+        for name, content in (("main.c", main_c), ("project.py", project_py)):
+            with open(os.path.join(s.basedir, name), "w") as f:
+                f.write(content)
+
+    def tearDown(s):
+        shutil.rmtree(s.basedir)
+
+    def test_link(s):
+        subprocess.check_call([sys.executable, pyjam], cwd=s.basedir,
+                stdout=subprocess.DEVNULL)
+
+        with open(os.path.join(s.basedir, "bin", "hello.args.rsp")) as f:
+            s.assertEqual(f.read().split(), ["-lm"])
+
+        output = subprocess.check_output([os.path.join(s.basedir, "bin", "hello")],
+                universal_newlines=True)
+        s.assertEqual(output, "4.0\n")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+#
+# Unity builds: adding or removing a source of a unity module (outside of
+# the project root) must regenerate its unity files.
+#
+# usage: python -m unittest discover tests
+#
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+pyjam = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "pyjam.py")
+
+project_py = '''\
+BuildContext.init("native", bindir="bin")
+Module.init_context()
+subinclude("core")
+subinclude("app")
+BuildContext.finalize()
+'''
+
+core_py = '''\
+Module("core", unity=4)
+'''
+
+app_py = '''\
+m = Module("app").needs("core")
+m.collect_modules()
+LinkModule(locate_bin("app.elf"), m.name)
+depends("all", locate_bin("app.elf"))
+'''
+
+main_c = '''\
+#include <stdio.h>
+%s
+int main(void)
+{
+    printf("%%d\\n", %s);
+    return 0;
+}
+'''
+
+@unittest.skipUnless(shutil.which("gcc"), "needs gcc")
+class UnityTest(unittest.TestCase):
+    def setUp(s):
+        s.basedir = tempfile.mkdtemp(prefix="pyjam-test-")
+        s.write("project.py", project_py)
+        s.write("core/build.py", core_py)
+        s.write("app/build.py", app_py)
+
+    def tearDown(s):
+        shutil.rmtree(s.basedir)
+
+    def write(s, name, content):
+        path = os.path.join(s.basedir, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(content)
+
+    def set_sources(s, *names):
+        for name in names:
+            s.write("core/%s.c" % name, "int %s(void) { return %i; }\n" % (name, ord(name)))
+        s.write("app/main.c", main_c % ("".join("int %s(void);\n" % name for name in names),
+                " + ".join("%s()" % name for name in names)))
+
+    def build_and_run(s):
+        subprocess.check_call([sys.executable, pyjam], cwd=s.basedir, stdout=subprocess.DEVNULL)
+        output = subprocess.check_output([os.path.join(s.basedir, "bin", "app.elf")],
+                universal_newlines=True)
+        return int(output)
+
+    def test_sources_change(s):
+        s.set_sources("a", "b")
+        s.assertEqual(s.build_and_run(), ord("a") + ord("b"))
+
+        s.set_sources("a", "b", "c")
+        s.assertEqual(s.build_and_run(), ord("a") + ord("b") + ord("c"))
+
+        os.unlink(os.path.join(s.basedir, "core", "b.c"))
+        s.set_sources("a", "c")
+        s.assertEqual(s.build_and_run(), ord("a") + ord("c"))
+
+if __name__ == '__main__':
+    unittest.main()